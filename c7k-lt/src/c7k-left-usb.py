@@ -2,6 +2,7 @@ import board
 import busio
 import time
 import digitalio
+import supervisor
 import usb_hid
 from adafruit_mcp230xx.mcp23008 import MCP23008
 from adafruit_hid.keyboard import Keyboard
@@ -35,19 +36,69 @@ pin_to_key_index = {
 pressed_keys = [False] * 7  # 7 keys (indexed 0-6)
 pending_combo = None
 last_combo_time = 0
-last_hold_time = 0
+last_hold_time = None         # ticks when the current chord was first seen; None when idle
 last_release_time = 0
 
-# Timing parameters
-minimum_hold_time = 0.01      # Seconds keys must be held to register a chord
-combo_time_window = 0.01      # Allowed time window for chord detection
-cooldown_time = 0.01          # (Unused now; replaced by repeat_delay for hold behavior)
-release_time_window = 0.01    # Time window to ensure keys are released before new detection
-double_press_window = 0.3     # Seconds allowed between taps for a double press
-repeat_delay = 0.2            # Delay between repeats when keys are held
+# Timing parameters (integer milliseconds, compared with ticks_diff)
+minimum_hold_time = 10        # ms keys must be held to register a chord
+combo_time_window = 10        # Allowed time window for chord detection (ms)
+cooldown_time = 10            # (Unused now; replaced by repeat_delay for hold behavior)
+release_time_window = 10      # Time window to ensure keys are released before new detection (ms)
+double_press_window = 300     # default ms allowed between taps of a tap dance
 
-last_backspace_time = 0
-last_space_time = 0
+# supervisor.ticks_ms() is an integer millisecond counter that wraps at 2**29.
+# Unlike time.monotonic() it keeps full ms resolution at any uptime, as long
+# as differences are taken with ticks_diff().
+TICKS_PERIOD = 1 << 29
+TICKS_MAX = TICKS_PERIOD - 1
+TICKS_HALFPERIOD = TICKS_PERIOD // 2
+
+def ticks_diff(t1, t2):
+    # Signed t1 - t2 in ms, correct across wraparound
+    diff = (t1 - t2) & TICKS_MAX
+    return ((diff + TICKS_HALFPERIOD) & TICKS_MAX) - TICKS_HALFPERIOD
+
+# Repeat while a chord is held:
+#   "host"     - keep the key down in the HID report and let the host OS apply
+#                its own typematic delay and rate; a long repeat is two reports
+#   "firmware" - re-send the key from here after repeat_delay, speeding up by
+#                repeat_acceleration per repeat down to repeat_min_interval
+#   None       - no repeat
+repeat_mode = "host"
+repeat_delay = 200            # ms before the first firmware repeat
+repeat_min_interval = 30      # fastest firmware repeat (ms)
+repeat_acceleration = 20      # ms shaved off the interval after each repeat; 0 = fixed rate
+repeat_wait = repeat_delay
+repeat_keycodes = None        # keycodes of the chord being held/repeated
+
+def press_chord(*keycodes):
+    # Send a newly detected chord and arm repeat for it
+    global repeat_keycodes, repeat_wait
+    keyboard.press(*keycodes)
+    if repeat_mode != "host":
+        keyboard.release_all()
+    repeat_keycodes = keycodes if repeat_mode else None
+    repeat_wait = repeat_delay
+
+def release_chord():
+    # The held chord changed or was released: stop repeating it
+    global repeat_keycodes
+    if repeat_keycodes is not None:
+        if repeat_mode == "host":
+            keyboard.release_all()
+        repeat_keycodes = None
+
+def repeat_chord(current_time):
+    # Firmware repeat for a chord that is still held; host repeat needs nothing
+    global last_combo_time, repeat_wait
+    if repeat_mode != "firmware" or repeat_keycodes is None:
+        return
+    if ticks_diff(current_time, last_combo_time) < repeat_wait:
+        return
+    keyboard.press(*repeat_keycodes)
+    keyboard.release_all()
+    last_combo_time = current_time
+    repeat_wait = max(repeat_min_interval, repeat_wait - repeat_acceleration)
 
 # Define chord mappings
 chords = {
@@ -55,7 +106,6 @@ chords = {
     (1,): Keycode.I,
     (2,): Keycode.A,
     (3,): Keycode.S,
-    (4,): Keycode.BACKSPACE,  # Normal mapping; now only sent on double-tap
     (0, 1): Keycode.R,
     (0, 2): Keycode.O,
     (0, 3): Keycode.C,
@@ -94,7 +144,6 @@ chords = {
     (0, 2, 3, 6): Keycode.LEFT_ARROW,
     (1, 2, 3, 6): Keycode.ESCAPE,
     (0, 1, 2, 3, 6): Keycode.DOWN_ARROW,
-    (6,): Keycode.SPACE,  # Also mapped here; double-tap takes precedence.
     (1, 4): Keycode.TAB,
     (2, 4): Keycode.PERIOD,
     (3, 4): Keycode.MINUS,
@@ -112,63 +161,113 @@ chords = {
     (0, 1, 2, 3, 4): Keycode.GRAVE_ACCENT
 }
 
+# Tap dance: chords that do different things depending on how they are tapped.
+# "taps" lists the keycode for one, two, three... taps (None for nothing),
+# "hold" the keycode for holding the chord. Optional per-entry windows (ms):
+# "tap_window" for the next tap, "hold_time" before a press counts as a hold.
+# Once no further tap could change the result, the action fires on that press
+# and repeats while held, so (4,) types BACKSPACE on its second press. Chords
+# listed here must not also be in chords.
+tap_dances = {
+    (4,): {"taps": (None, Keycode.BACKSPACE)},
+    (6,): {"taps": (None, Keycode.SPACE)},
+}
+for combo, entry in tap_dances.items():
+    tap_dances[combo] = (entry.get("taps", ()), entry.get("hold"),
+                         entry.get("tap_window", double_press_window),
+                         entry.get("hold_time", repeat_delay))
+
+# Tap-dance state. A dance is resolved by a single deadline, not by checks on
+# each scan: hold_time after a press (if the entry has a hold action), or
+# tap_window after a release. Other chords only test dance_combo when they fire.
+dance_combo = None      # chord being tapped, None when no dance is pending
+dance_taps = 0
+dance_deadline = None   # ticks at which the pending dance resolves
+
+def tap_key(keycode):
+    if keycode is not None:
+        keyboard.press(keycode)
+        keyboard.release_all()
+
+def finish_tap_dance():
+    # Resolve a pending dance as the taps counted so far
+    global dance_combo, dance_deadline
+    taps = tap_dances[dance_combo][0]
+    if dance_taps <= len(taps):
+        tap_key(taps[dance_taps - 1])
+    dance_combo = None
+    dance_deadline = None
+
+def tap_dance_press(combo, current_time):
+    global dance_combo, dance_taps, dance_deadline
+    if dance_combo is not None and dance_combo != combo:
+        finish_tap_dance()
+    if dance_combo is None:
+        dance_combo = combo
+        dance_taps = 0
+    dance_taps += 1
+    taps, hold, tap_window, hold_time = tap_dances[combo]
+    if dance_taps >= len(taps) and hold is None:
+        # No later tap or hold can change the result: fire now, held
+        dance_combo = None
+        dance_deadline = None
+        if dance_taps == len(taps) and taps[-1] is not None:
+            press_chord(taps[-1])
+    elif hold is not None:
+        dance_deadline = (current_time + hold_time) & TICKS_MAX
+    else:
+        dance_deadline = None
+
+def tap_dance_release(current_time):
+    global dance_deadline
+    dance_deadline = (current_time + tap_dances[dance_combo][2]) & TICKS_MAX
+
+def tap_dance_timeout():
+    global dance_combo, dance_deadline
+    if pending_combo == dance_combo:
+        # Still held: a hold
+        press_chord(tap_dances[dance_combo][1])
+        dance_combo = None
+        dance_deadline = None
+    else:
+        finish_tap_dance()
+
 def check_chords():
     global pending_combo, last_combo_time, last_hold_time, last_release_time
-    global last_backspace_time, last_space_time
     current_combo = tuple(i for i, pressed in enumerate(pressed_keys) if pressed)
-    current_time = time.monotonic()
+    current_time = supervisor.ticks_ms()
+    if dance_deadline is not None and ticks_diff(current_time, dance_deadline) >= 0:
+        tap_dance_timeout()
 
     if current_combo:
+        if current_combo != pending_combo:
+            release_chord()
+
         # Set initial hold time if not already set.
-        if last_hold_time == 0:
+        if last_hold_time is None:
             last_hold_time = current_time
 
-        if (current_time - last_hold_time) >= minimum_hold_time:
-            # Special handling for the (4,) chord (BACKSPACE)
-            if current_combo == (4,):
-                if last_backspace_time != 0 and (current_time - last_backspace_time) <= double_press_window:
-                    # Only repeat if this is a new detection or enough time has passed.
-                    if pending_combo != current_combo or (current_time - last_combo_time) >= repeat_delay:
-                        keyboard.press(Keycode.BACKSPACE)
-                        keyboard.release_all()
-                        last_backspace_time = 0  # Reset after double-tap
-                        pending_combo = current_combo
-                        last_combo_time = current_time
-                else:
-                    last_backspace_time = current_time
-
-            # Special handling for the (6,) chord (SPACE)
-            elif current_combo == (6,):
-                if last_space_time != 0 and (current_time - last_space_time) <= double_press_window:
-                    if pending_combo != current_combo or (current_time - last_combo_time) >= repeat_delay:
-                        keyboard.press(Keycode.SPACE)
-                        keyboard.release_all()
-                        last_space_time = 0  # Reset after double-tap
-                        pending_combo = current_combo
-                        last_combo_time = current_time
-                else:
-                    last_space_time = current_time
-
-            # Normal chord handling for all other chords.
+        if ticks_diff(current_time, last_hold_time) >= minimum_hold_time:
+            if pending_combo == current_combo:
+                # Same chord still held after it fired
+                repeat_chord(current_time)
             elif current_combo in chords:
-                if pending_combo == current_combo:
-                    if (current_time - last_combo_time) >= repeat_delay:
-                        keyboard.press(chords[current_combo])
-                        keyboard.release_all()
-                        last_combo_time = current_time
-                else:
-                    keyboard.press(chords[current_combo])
-                    keyboard.release_all()
-                    pending_combo = current_combo
-                    last_combo_time = current_time
+                if dance_combo is not None:
+                    finish_tap_dance()
+                press_chord(chords[current_combo])
+                pending_combo = current_combo
+                last_combo_time = current_time
+            elif current_combo in tap_dances:
+                tap_dance_press(current_combo, current_time)
+                pending_combo = current_combo
+                last_combo_time = current_time
     else:
         # Reset states when no keys are pressed.
-        if last_backspace_time != 0 and (current_time - last_backspace_time > double_press_window):
-            last_backspace_time = 0
-        if last_space_time != 0 and (current_time - last_space_time > double_press_window):
-            last_space_time = 0
+        release_chord()
+        if pending_combo is not None and pending_combo == dance_combo:
+            tap_dance_release(current_time)
         pending_combo = None
-        last_hold_time = 0
+        last_hold_time = None
         last_release_time = current_time
 
 while True:
@@ -1,62 +1,277 @@
+import array
 import board
-import busio
 import time
 import digitalio
+import gc
+import os
+import supervisor
+import usb_hid
+import usb_cdc
+import microcontroller
+import chordfit
+import c7kmap
+import c7klink
+from c7kboard import TICKS_MAX, ticks_diff, wait_for_i2c, KeyRepeat
 from adafruit_mcp230xx.mcp23008 import MCP23008
-import adafruit_ble
-from adafruit_ble.advertising.standard import ProvideServicesAdvertisement
-from adafruit_ble.services.standard.hid import HIDService
-from adafruit_hid.keyboard import Keyboard
+from adafruit_hid import find_device
 from adafruit_hid.keycode import Keycode
-from adafruit_hid.mouse import Mouse
+
+# Boot timing: ms since reset (so including boot.py) at each startup stage,
+# printed once the first report has gone out and readable as metrics
+def uptime_ms():
+    return time.monotonic_ns() // 1000000
+
+boot_marks = [("imports", uptime_ms())]
+first_report_ticks = None  # ticks_ms of the first report; uptime_ms() allocates, so not on the report path
+
+def first_report_uptime():
+    # ms since reset of the first report, 0 if none has gone out yet
+    if first_report_ticks is None:
+        return 0
+    return uptime_ms() - ticks_diff(supervisor.ticks_ms(), first_report_ticks)
 
 # --- Turn on external VCC (P0.13 high) ---
 vcc_enable = digitalio.DigitalInOut(board.VCC_OFF)
 vcc_enable.direction = digitalio.Direction.OUTPUT
 vcc_enable.value = True
 
-time.sleep(0.5)  # Allow power to stabilize
+# Input backend:
+#   "mcp23008" - scan the two expanders over I2C from the main loop
+#   "keypad"   - keys wired directly to the nice!nano, scanned in C by keypad.Keys
+input_backend = "mcp23008"
+
+# Directly wired keys for the keypad backend, in logical key order:
+# left hand 0-6, then right hand 0-6 (finger keys already flipped).
+# Trim to the first 7 pins for a single hand.
+keypad_pins = (
+    board.P0_06, board.P0_08, board.P0_22, board.P0_24,  # left fingers 0-3
+    board.P1_00, board.P0_11, board.P1_04,                # left thumbs 4-6
+    board.P1_06, board.P1_11, board.P1_13, board.P1_15,  # right fingers 0-3
+    board.P0_02, board.P0_29, board.P0_31,                # right thumbs 4-6
+)
+keypad_debounce = 0.005  # keypad.Keys scan interval (seconds)
+
+if input_backend == "keypad":
+    import keypad
+    keys = keypad.Keys(keypad_pins, value_when_pressed=False, pull=True,
+                       interval=keypad_debounce, max_events=64)
+    key_event = keypad.Event()
+else:
+    # Setup I2C and MCP23008 expanders
+    i2c = wait_for_i2c((0x20, 0x21))
+    mcp_left = MCP23008(i2c, address=0x20)
+    mcp_right = MCP23008(i2c, address=0x21)
+    mcps = [mcp_left, mcp_right]
+
+    # Configure all pins on both expanders
+    for mcp in mcps:
+        for i in range(7):
+            pin = mcp.get_pin(i)
+            pin.direction = digitalio.Direction.INPUT
+            pin.pull = digitalio.Pull.UP
+boot_marks.append(("inputs", uptime_ms()))
+
+# Output routing:
+#   "auto" - USB while it is enumerated, BLE otherwise
+#   "usb"  - USB only (BLE is never started)
+#   "ble"  - BLE only
+#   "both" - every connected transport
+# A chord held at power-on overrides this for one boot (see boot.py).
+output_mode = "auto"
+
+NVM_HOST_SLOT = 0  # nvm byte holding the active BLE host slot
+NVM_BOOT_MODE = 1  # nvm byte where boot.py leaves the mode picked at power-on
+NVM_TIMING = 16    # nvm offset of the calibrated timing block (chordfit settings)
+NVM_KEYMAP = 32    # nvm offset of a keymap uploaded over the control channel
+
+boot_modes = ("auto", "usb", "ble", "both")  # same order as in boot.py
+if microcontroller.nvm[NVM_BOOT_MODE] < len(boot_modes):
+    output_mode = boot_modes[microcontroller.nvm[NVM_BOOT_MODE]]
 
-# Setup I2C and MCP23008 expanders
-i2c = busio.I2C(scl=board.SCL, sda=board.SDA, frequency=400000)
-mcp_left = MCP23008(i2c, address=0x20)
-mcp_right = MCP23008(i2c, address=0x21)
-mcps = [mcp_left, mcp_right]
+# Host slots. Each slot advertises under its own BLE address (the chip's
+# address with the low byte varied), so every host keeps its own bond and the
+# bonds of the other slots are never touched. The active slot is remembered
+# in microcontroller.nvm across power cycles.
+host_slots = 3
+host_name = "c7kfo-%d"
+active_host = microcontroller.nvm[NVM_HOST_SLOT]
+if active_host >= host_slots:
+    active_host = 0
+pending_host = None  # slot to switch to once the current link is down
 
-# Configure all pins on both expanders
-for mcp in mcps:
-    for i in range(7):
-        pin = mcp.get_pin(i)
-        pin.direction = digitalio.Direction.INPUT
-        pin.pull = digitalio.Pull.UP
+# BLE HID setup. The BLE stack is only imported, and the radio only started,
+# when the output mode can use it.
+if output_mode != "usb":
+    import _bleio
+    import adafruit_ble
+    from adafruit_ble.advertising.standard import ProvideServicesAdvertisement
+    from adafruit_ble.services.standard.hid import HIDService
 
-# BLE HID setup
-ble = adafruit_ble.BLERadio()
-hid = HIDService()
-advertisement = ProvideServicesAdvertisement(hid)
-keyboard = Keyboard(hid.devices)
-mouse = Mouse(hid.devices)
+    ble = adafruit_ble.BLERadio()
+    hid = HIDService()
+    advertisement = ProvideServicesAdvertisement(hid)
+    advertising_interval = 0.02  # seconds; short so a host reconnects quickly
+
+    base_address = _bleio.adapter.address
+    host_addresses = []
+    for slot in range(host_slots):
+        address = bytearray(base_address.address_bytes)
+        address[0] ^= slot
+        host_addresses.append(_bleio.Address(bytes(address), base_address.type))
+    _bleio.adapter.address = host_addresses[active_host]
+    ble.name = host_name % (active_host + 1)
+
+    ble_keyboard = find_device(hid.devices, usage_page=0x1, usage=0x06)
+    ble_mouse = find_device(hid.devices, usage_page=0x1, usage=0x02)
+else:
+    ble = None
+    ble_keyboard = ble_mouse = None
+boot_marks.append(("radio", uptime_ms()))
+
+# USB HID devices. Absent if boot.py disabled USB HID.
+try:
+    usb_keyboard = find_device(usb_hid.devices, usage_page=0x1, usage=0x06)
+    usb_mouse = find_device(usb_hid.devices, usage_page=0x1, usage=0x02)
+except ValueError:
+    usb_keyboard = usb_mouse = None
+
+# Devices reports currently go to; only the first output_count entries are live
+keyboard_outputs = [None, None]
+mouse_outputs = [None, None]
+output_count = 0
+usb_active = False
+ble_active = False
+
+# Reports are written into preallocated buffers and sent directly, so pressing
+# a chord does not build keycode tuples, and every transport gets the same bytes
+key_report = bytearray(8)  # [modifiers, reserved, key, 0, 0, 0, 0, 0]
+release_report = bytes(8)
+
+def send_keyboard(report):
+    global report_count, first_report_ticks
+    report_count += 1
+    if report_count == 1:
+        first_report_ticks = supervisor.ticks_ms()
+    if tail_enabled:
+        tail_report(0, report)
+    for i in range(output_count):
+        try:
+            keyboard_outputs[i].send_report(report)
+        except OSError:
+            pass  # transport went away mid-send; update_outputs() drops it
+
+def send_mouse(report):
+    global report_count
+    report_count += 1
+    if tail_enabled:
+        tail_report(1, report)
+    for i in range(output_count):
+        try:
+            mouse_outputs[i].send_report(report)
+        except OSError:
+            pass
 
 # Map MCP pin to key index (logical 0–6)
 pin_to_key_index = {
     0: 0, 1: 1, 2: 2, 3: 3, 4: 4, 5: 5, 6: 6
 }
 
-# Key state tracking (7 left + 7 right)
-pressed_keys = [False] * 14
+# Key state tracking: logical key bitmask per hand (bit n = key n), left then right
+hand_masks = [0, 0]
+
+# MCP23008 GPIO register value → logical key bitmask for each hand (active low,
+# right-hand finger keys 0–3 flipped). One register read per expander per scan
+# replaces seven get_pin() wrappers.
+gpio_to_mask = [bytearray(256), bytearray(256)]
+for hand_index in range(2):
+    for gpio in range(256):
+        mask = 0
+        for pin, key_index in pin_to_key_index.items():
+            if not gpio & (1 << pin):
+                if hand_index == 1 and key_index in (0, 1, 2, 3):
+                    key_index = 3 - key_index
+                mask |= 1 << key_index
+        gpio_to_mask[hand_index][gpio] = mask
+
+debug = False             # print layer changes to the serial console
+selftest = True           # check at boot that the scan path allocates nothing
 
-# Layer and chord state
-pending_combo = None
+# Chord state
+pending_mask = 0          # bitmask of the chord that last fired, 0 when none
 last_combo_time = 0
-last_hold_time = 0
+last_hold_time = None
 last_release_time = 0
-cooldown_time = 0.01
-combo_time_window = 0.01
-minimum_hold_time = 0.01
+keys_settled = False      # False until every key held at startup has been released
+cooldown_time = 0.01      # seconds, passed to time.sleep
+combo_time_window = 10    # ms
+minimum_hold_time = 10    # ms
+
+# Speculative output: type a chord's character on the first scan that sees
+# its keys instead of after minimum_hold_time. If the keys held at
+# minimum_hold_time turn out to be another chord (0 = E growing into
+# 0 1 = R), one burst sends a backspace and that chord instead. Only chords
+# that type a plain character are guessed, and only when no one-key
+# extension of the chord does anything on the active layers, or when at
+# least speculate_min_strokes recent strokes started with it and at most
+# speculate_max_wrong percent of them grew.
+# GET_METRICS and the heap report give the miss rate.
+speculate = False
+speculate_max_wrong = 10  # percent
+speculate_min_strokes = 8  # strokes seen before a chord with extensions is guessed
+
+# Repeat while a chord is held: "host", "firmware" or None, see c7kboard.KeyRepeat
+key_repeat = KeyRepeat(mode="host", delay=300, min_interval=30, acceleration=20)
+repeat_key = 0                # keycode of the chord being held/repeated
+repeat_mods = 0               # its HID modifier bits
+
+def send_key(mods, keycode):
+    key_report[0] = mods
+    key_report[2] = keycode
+    send_keyboard(key_report)
+
+def press_chord(mods, keycode):
+    # Send a newly detected chord and arm repeat for it
+    global repeat_key, repeat_mods
+    send_key(mods, keycode)
+    if key_repeat.press():
+        send_keyboard(release_report)
+    repeat_key = keycode
+    repeat_mods = mods
+
+def release_chord():
+    # The held chord changed or was released: stop repeating it
+    if key_repeat.release():
+        send_keyboard(release_report)
+
+def repeat_chord(current_time):
+    # Firmware repeat for a chord that is still held; host repeat needs nothing
+    global last_combo_time
+    if key_repeat.host_repeating(current_time, last_combo_time):
+        # The host may be repeating the key by now, so undo cannot count it
+        history_barrier()
+    elif key_repeat.due(current_time, last_combo_time):
+        send_key(repeat_mods, repeat_key)
+        send_keyboard(release_report)
+        history_repeat()
+        last_combo_time = current_time
+
+def apply_timing(settings):
+    global minimum_hold_time, combo_time_window
+    minimum_hold_time = settings.get("minimum_hold_time", minimum_hold_time)
+    combo_time_window = settings.get("combo_time_window", combo_time_window)
+    key_repeat.delay = settings.get("repeat_delay", key_repeat.delay)
 
-# Modifier layer
-modifier_layer_armed = False
-held_modifier = None
+# Timing fitted by a calibration session (below) replaces the defaults above
+calibrated = chordfit.unpack_settings(
+    microcontroller.nvm[NVM_TIMING:NVM_TIMING + chordfit.SETTINGS_SIZE])
+if calibrated:
+    apply_timing(calibrated)
+
+# Modifier layer: layer_trigger_chord arms it for one chord, which picks the
+# modifiers applied to the chord after that. Modifier fingers can be chorded
+# together, and chorded with layer_trigger_chord to skip the arming stroke,
+# e.g. (1, 5, 6) then (0, 3) sends Ctrl+C. One-shot modifiers stack until a
+# key uses them.
 layer_trigger_chord = (5, 6)
 modifier_chords = {
     (0,): Keycode.LEFT_SHIFT,
@@ -65,9 +280,64 @@ modifier_chords = {
     (3,): Keycode.LEFT_GUI
 }
 
+# Modifier hand: set to 0 (left) or 1 (right) to stop chording on that hand
+# and use its keys as held modifiers for chords typed on the other hand, so a
+# shortcut is one stroke and one report. Keys are logical indices on that hand.
+modifier_hand = None
+modifier_hand_keys = {
+    0: Keycode.LEFT_SHIFT,
+    1: Keycode.LEFT_CONTROL,
+    2: Keycode.LEFT_ALT,
+    3: Keycode.LEFT_GUI,
+}
+
 # Mouse layer
-mouse_layer_armed = False
 mouse_trigger_chord = (4, 5)  # toggle on/off
+mouse_moves = ((0, -10), (10, 0), (-10, 0), (0, 10))  # up, right, left, down
+# Pre-encoded mouse reports: [buttons, x, y, wheel]
+mouse_move_reports = [bytes((0, dx & 0xFF, dy & 0xFF, 0)) for dx, dy in mouse_moves]
+
+# Undo: undo_chord deletes what the last stroke typed (a character, a
+# sequence's word) with one burst of backspaces, and again for the stroke
+# before, back through the last history_size strokes. It stops at a stroke it
+# cannot reverse that way: a shortcut, an arrow or other non-typing key, or a
+# key held long enough for the host to repeat it.
+undo_chord = (1, 2, 4)
+history_size = 32
+
+# BLE host switching: finger + thumbs 4 and 6 selects host slot 1-3
+host_chords = {(0, 4, 6): 0, (1, 4, 6): 1, (2, 4, 6): 2}
+
+# Timing calibration: calibrate_chord starts a session of the prompts below,
+# printed to the serial console as (keys) xtaps. The fitted timing is applied
+# at once and saved to nvm; the raw trace is printed as "@" lines that
+# host-calibrate.py can refit offline. With the MCP23008 backend, event times
+# are only as fine as the scan interval.
+calibrate_chord = (4, 5, 6)
+calibration_prompts = (
+    ((0,), 1), ((0, 1), 1), ((1, 2), 1), ((2, 3), 1), ((0, 1, 2), 1),
+    ((1, 2, 3), 1), ((0, 1, 2, 3), 1), ((0, 5), 1), ((1, 3, 5), 1), ((0, 1, 2, 5), 1),
+    ((0, 1, 2, 3, 5), 1), ((0, 6), 1), ((0, 2, 6), 1), ((0, 1, 3, 6), 1), ((1, 4), 1),
+    ((0, 1, 4), 1), ((2, 3, 4), 1), ((0, 2, 3, 4), 1), ((3,), 1), ((0, 3), 1),
+    ((6,), 2), ((0,), 2), ((0, 1), 2),
+)
+
+# Multi-stroke sequences, steno-brief style: a prefix chord, then a chord
+# that types a word (a str) or does any layer action (an int). Prefixes can
+# nest for three or more strokes. A stroke the sequence does not know is
+# typed as an ordinary chord and ends the sequence, as does a pause longer
+# than sequence_timeout.
+sequence_timeout = 1000  # ms
+sequences = {
+    ((4, 6), (2, 3)): "the ",
+    ((4, 6), (2,)): "and ",
+    ((4, 6), (0, 2)): "of ",
+    ((4, 6), (0, 2, 5)): "with ",
+    ((4, 6), (1,)): "ing ",
+    ((4, 6), (0, 1, 5)): "you ",
+    ((4, 6), (1, 2)): "not ",
+    ((4, 6), (0, 3)): "can ",
+}
 
 # Main chord dictionary
 chords = {
@@ -91,112 +361,1044 @@ chords = {
     (2, 3, 4): Keycode.FORWARD_SLASH, (0, 1, 4): Keycode.ENTER,
     (0, 2, 4): Keycode.EQUALS,
     (1, 3, 4): Keycode.LEFT_BRACKET, (0, 3, 4): Keycode.RIGHT_BRACKET,
-    (2, 3, 4): Keycode.BACKSLASH, (1, 2, 4): Keycode.BACKSPACE,
+    (2, 3, 4): Keycode.BACKSLASH,
     (0, 1, 3, 4): Keycode.QUOTE, (0, 2, 3, 4): Keycode.SEMICOLON,
     (0, 1, 2, 3, 4): Keycode.GRAVE_ACCENT
 }
 
-# BLE connect
-ble.start_advertising(advertisement)
-while not ble.connected:
-    pass
-ble.stop_advertising()
-
-# Chord detection
-def check_chords():
-    global pending_combo, last_combo_time, last_hold_time, last_release_time
-    global modifier_layer_armed, held_modifier, mouse_layer_armed
-    current_time = time.monotonic()
-    current_combo = tuple(i % 7 for i, pressed in enumerate(pressed_keys) if pressed)
-
-    if current_combo:
-        if last_hold_time == 0:
+# Layer actions are small ints, (kind << 8) | argument, so each layer compiles
+# to a flat 128-entry table indexed by the chord's key bitmask (bit n = key n,
+# both hands folded together).
+from c7kmap import (ACT_NONE, ACT_KEY, ACT_TOGGLE, ACT_MOMENTARY, ACT_ONCE, ACT_ONESHOT,
+                    ACT_MOUSE, ACT_HOST, ACT_CALIBRATE, ACT_SEQUENCE, ACT_TEXT,
+                    ACT_UNDO, TRANSPARENT)
+
+def key(keycode):
+    return (ACT_KEY << 8) | keycode
+
+def toggle(layer):
+    return (ACT_TOGGLE << 8) | layer
+
+def momentary(layer):
+    return (ACT_MOMENTARY << 8) | layer
+
+def once(layer):
+    return (ACT_ONCE << 8) | layer
+
+def modifier_bit(modifier):
+    # LEFT_CONTROL..RIGHT_GUI are 0xE0..0xE7, bits 0-7 of the HID modifier byte
+    return 1 << (modifier - Keycode.LEFT_CONTROL)
+
+def oneshot(*modifiers):
+    bits = 0
+    for modifier in modifiers:
+        bits |= modifier_bit(modifier)
+    return (ACT_ONESHOT << 8) | bits
+
+def mouse_action(move):
+    return (ACT_MOUSE << 8) | move
+
+def host(slot):
+    return (ACT_HOST << 8) | slot
+
+def calibrate():
+    return ACT_CALIBRATE << 8
+
+def sequence(layer):
+    return (ACT_SEQUENCE << 8) | layer
+
+def text(index):
+    return (ACT_TEXT << 8) | index
+
+def undo():
+    return ACT_UNDO << 8
+
+BASE, MOUSE, MODIFIER = 0, 1, 2
+layer_names = ("Base", "Mouse", "Modifier")
+
+base_layer = {combo: key(keycode) for combo, keycode in chords.items()}
+base_layer[mouse_trigger_chord] = toggle(MOUSE)
+base_layer[layer_trigger_chord] = once(MODIFIER)
+base_layer[calibrate_chord] = calibrate()
+base_layer[undo_chord] = undo()
+for combo, slot in host_chords.items():
+    base_layer[combo] = host(slot)
+
+mouse_layer = {
+    (0,): mouse_action(0), (1,): mouse_action(1),
+    (2,): mouse_action(2), (3,): mouse_action(3),
+    mouse_trigger_chord: TRANSPARENT,
+}
+
+modifier_layer = {}
+for bits in range(1, 1 << len(modifier_chords)):
+    fingers = tuple(f for f in range(len(modifier_chords)) if bits & (1 << f))
+    action = oneshot(*(modifier_chords[(f,)] for f in fingers))
+    modifier_layer[fingers] = action
+    # One-stroke form; on the modifier layer too, for when the thumbs land
+    # first and fire once(MODIFIER) before the fingers join
+    base_layer[fingers + layer_trigger_chord] = action
+    modifier_layer[fingers + layer_trigger_chord] = action
+modifier_layer[mouse_trigger_chord] = TRANSPARENT
+modifier_layer[layer_trigger_chord] = TRANSPARENT
+# Calibration and host switching reach through both layers: calibrate_chord
+# holds both trigger chords, so it would otherwise be masked by the layer
+# it turns on
+for combo in [calibrate_chord] + list(host_chords):
+    mouse_layer[combo] = TRANSPARENT
+    modifier_layer[combo] = TRANSPARENT
+
+def chord_mask(combo):
+    mask = 0
+    for i in combo:
+        mask |= 1 << i
+    return mask
+
+def compile_layer(layer):
+    table = [ACT_NONE] * 128
+    for combo, action in layer.items():
+        table[chord_mask(combo)] = action
+    return table
+
+# Sequences compile to a prefix tree of extra layers: each prefix gets one
+# state layer mapping the next stroke to its action, so a stroke is resolved
+# with one table index whatever the number of sequences.
+layers = [base_layer, mouse_layer, modifier_layer]
+keymap_texts = []  # (modifier bits, keycode) per character, see c7kmap.encode_text
+sequence_states = {}
+for strokes, output in sequences.items():
+    layer = base_layer
+    for n in range(1, len(strokes)):
+        prefix = strokes[:n]
+        if prefix not in sequence_states:
+            sequence_states[prefix] = len(layers)
+            layer[strokes[n - 1]] = sequence(len(layers))
+            layers.append({})
+        layer = layers[sequence_states[prefix]]
+    if isinstance(output, str):
+        layer[strokes[-1]] = text(len(keymap_texts))
+        keymap_texts.append(c7kmap.encode_text(output))
+    else:
+        layer[strokes[-1]] = output
+del sequence_states
+
+# Layers and texts stay packed in the c7kmap format and are read in place, two
+# bytes per lookup: keymap_store is the keymap's bytes (RAM) or
+# microcontroller.nvm (flash, nothing resident) with the keymap at keymap_base.
+# The source dicts are dropped once packed.
+keymap_store = c7kmap.pack([compile_layer(layer) for layer in layers], {}, keymap_texts)
+keymap_base = 0
+keymap_length = len(keymap_store)
+keymap_layers = len(layers)
+keymap_text_offsets = c7kmap.text_offsets(keymap_store, keymap_layers)  # from keymap_base
+del layers, base_layer, mouse_layer, modifier_layer, keymap_texts
+
+def layer_action(layer, mask):
+    i = keymap_base + c7kmap.HEADER_SIZE + layer * c7kmap.LAYER_SIZE + 2 * mask
+    return keymap_store[i] | (keymap_store[i + 1] << 8)
+
+def keymap_ram():
+    # Bytes the keymap keeps resident: the packed layers and texts unless they
+    # run from flash, plus active_table
+    return (0 if keymap_store is microcontroller.nvm else keymap_length) + 2 * len(active_table)
+
+# Active layers, bottom to top. active_table is the stack flattened (transparent
+# entries resolved), rebuilt only when the stack changes, so resolving a scan is
+# one index whatever the number of layers. It is the only unpacked table.
+layer_stack = [BASE]
+active_table = array.array("H", (ACT_NONE for _ in range(128)))
+once_layer = None        # layer to drop after the next chord
+momentary_layer = None   # layer held by momentary_mask's keys
+momentary_mask = 0
+oneshot_mods = 0         # HID modifier bits waiting for the next key
+sequence_layer = None    # state layer of a sequence in progress
+held_mods = 0            # HID modifier bits held on the modifier hand
+final_chords = bytearray(128)  # 1 where no one-key extension of the chord has an action
+
+# Modifier-hand key bitmask → HID modifier bits
+modifier_hand_mods = bytearray(128)
+for hand_mask in range(128):
+    for key_index, modifier in modifier_hand_keys.items():
+        if hand_mask & (1 << key_index):
+            modifier_hand_mods[hand_mask] |= modifier_bit(modifier)
+
+def rebuild_active_table():
+    for mask in range(128):
+        action = TRANSPARENT
+        i = len(layer_stack) - 1
+        while action == TRANSPARENT and i >= 0:
+            action = layer_action(layer_stack[i], mask)
+            i -= 1
+        active_table[mask] = ACT_NONE if action == TRANSPARENT else action
+    if speculate:
+        for mask in range(1, 128):
+            final_chords[mask] = 1
+            for i in range(7):
+                extended = mask | (1 << i)
+                if extended != mask and active_table[extended] != ACT_NONE:
+                    final_chords[mask] = 0
+                    break
+
+rebuild_active_table()
+
+def push_layer(layer):
+    if layer in layer_stack:
+        layer_stack.remove(layer)
+    layer_stack.append(layer)
+    rebuild_active_table()
+
+def pop_layer(layer):
+    if layer in layer_stack:
+        layer_stack.remove(layer)
+        rebuild_active_table()
+
+# Output history for undo: a ring of the last history_size strokes, each the
+# number of characters it typed (0 for a stroke undo cannot reverse) and the
+# modifiers it was sent with. Fixed bytearrays, so recording never allocates.
+history_counts = bytearray(history_size)
+history_mods = bytearray(history_size)
+history_end = 0          # slot of the next stroke
+history_length = 0       # strokes held, at most history_size
+SHIFT_MODS = 0x22        # left and right Shift; any other modifier makes a shortcut
+
+# Keycodes that type a character (US layout), so one backspace removes it
+typing_keys = bytearray(256)
+for key_index, char in enumerate(c7kmap.TEXT_KEYS):
+    if char not in "\x00\x1b\b":
+        typing_keys[c7kmap.TEXT_FIRST_KEY + key_index] = 1
+backspace_report = bytes((0, 0, Keycode.BACKSPACE, 0, 0, 0, 0, 0))
+
+def history_push(count, mods):
+    global history_end, history_length
+    history_counts[history_end] = min(count, 255)
+    history_mods[history_end] = mods
+    history_end = (history_end + 1) % history_size
+    if history_length < history_size:
+        history_length += 1
+
+def history_last():
+    # Slot of the last stroke, -1 when there is none
+    return (history_end - 1) % history_size if history_length else -1
+
+def history_barrier():
+    # The last stroke can no longer be undone with backspaces
+    last = history_last()
+    if last >= 0:
+        history_counts[last] = 0
+
+def history_repeat():
+    # A firmware repeat typed the last stroke's key once more
+    last = history_last()
+    if last >= 0 and 0 < history_counts[last] < 255:
+        history_counts[last] += 1
+
+def history_pop():
+    global history_end, history_length
+    history_end = (history_end - 1) % history_size
+    history_length -= 1
+
+def history_clear():
+    global history_length
+    history_length = 0
+
+def record_key(mods, keycode):
+    # Backspace takes back one character of the last stroke; any other key
+    # is a stroke of its own
+    last = history_last()
+    if keycode == Keycode.BACKSPACE and not mods & ~SHIFT_MODS and last >= 0 and history_counts[last]:
+        history_counts[last] -= 1
+        if not history_counts[last]:
+            history_pop()
+    else:
+        history_push(typing_keys[keycode], mods)
+
+# Action handlers, indexed by action kind
+def do_key(keycode, mask):
+    # Modifiers and key go out in one report
+    global oneshot_mods
+    press_chord(oneshot_mods | held_mods, keycode)
+    record_key(oneshot_mods | held_mods, keycode)
+    oneshot_mods = 0
+    time.sleep(cooldown_time)
+
+def do_toggle(layer, mask):
+    global oneshot_mods
+    oneshot_mods = 0
+    if layer in layer_stack:
+        pop_layer(layer)
+    else:
+        push_layer(layer)
+    if debug:
+        name = layer_names[layer] if layer < len(layer_names) else layer
+        print(name, "Layer:", "ON" if layer in layer_stack else "OFF")
+
+def do_momentary(layer, mask):
+    global momentary_layer, momentary_mask
+    momentary_layer = layer
+    momentary_mask = mask
+    push_layer(layer)
+
+def do_once(layer, mask):
+    global once_layer
+    once_layer = layer
+    push_layer(layer)
+
+def do_oneshot(bits, mask):
+    global oneshot_mods
+    oneshot_mods |= bits
+
+def do_mouse(move, mask):
+    send_mouse(mouse_move_reports[move])
+    time.sleep(cooldown_time)
+
+def do_host(slot, mask):
+    # Drop the current BLE link; update_outputs() moves to the new slot's
+    # address once it is down. Scanning carries on meanwhile.
+    global pending_host
+    if ble is None or (slot == active_host and pending_host is None):
+        return
+    pending_host = slot
+    for connection in ble.connections:
+        connection.disconnect()
+
+def do_calibrate(arg, mask):
+    start_calibration()
+
+def do_sequence(layer, mask):
+    # The next stroke is looked up in the sequence's state layer
+    global sequence_layer
+    sequence_layer = layer
+
+def do_text(index, mask):
+    # One press and one release report per character; one-shot and held
+    # modifiers apply to the first character, e.g. Shift capitalises a word
+    global oneshot_mods
+    offset = keymap_base + keymap_text_offsets[index]
+    mods = oneshot_mods | held_mods
+    history_push(keymap_store[offset], mods)
+    for i in range(offset + 1, offset + 1 + 2 * keymap_store[offset], 2):
+        send_key(keymap_store[i] | mods, keymap_store[i + 1])
+        send_keyboard(release_report)
+        mods = 0
+    oneshot_mods = 0
+    time.sleep(cooldown_time)
+
+def do_undo(arg, mask):
+    # Backspaces for the whole stroke go out back to back, without the
+    # cooldown between chords; a shortcut's effect cannot be taken back
+    global oneshot_mods
+    oneshot_mods = 0
+    last = history_last()
+    if last < 0 or not history_counts[last] or history_mods[last] & ~SHIFT_MODS:
+        if debug:
+            print("Undo: nothing to undo")
+        return
+    for _ in range(history_counts[last]):
+        send_keyboard(backspace_report)
+        send_keyboard(release_report)
+    history_pop()
+    time.sleep(cooldown_time)
+
+action_handlers = (None, do_key, do_toggle, do_momentary, do_once, do_oneshot, do_mouse,
+                   do_host, do_calibrate, do_sequence, do_text, do_undo)
+
+def switch_host():
+    global active_host, pending_host
+    if ble.advertising:
+        ble.stop_advertising()
+    _bleio.adapter.address = host_addresses[pending_host]
+    ble.name = host_name % (pending_host + 1)
+    active_host = pending_host
+    pending_host = None
+    if debug:
+        print("Host:", active_host + 1)
+
+def update_outputs():
+    # Follow the cable and the BLE link. Runs every pass but only touches the
+    # route when a transport comes or goes; keys on the dropped route are
+    # released first so nothing sticks down on that host.
+    global output_count, usb_active, ble_active
+    usb_up = (usb_keyboard is not None and output_mode != "ble"
+              and supervisor.runtime.usb_connected)
+    ble_up = (output_mode != "usb" and ble.connected
+              and not (output_mode == "auto" and usb_up))
+    if pending_host is not None and not ble.connected:
+        switch_host()
+    if output_mode != "usb" and not ble.connected and not ble.advertising:
+        ble.start_advertising(advertisement, interval=advertising_interval)
+    if usb_up == usb_active and ble_up == ble_active:
+        return
+
+    release_chord()
+    history_clear()  # the next stroke may land on another host
+    output_count = 0
+    if usb_up:
+        keyboard_outputs[output_count] = usb_keyboard
+        mouse_outputs[output_count] = usb_mouse
+        output_count += 1
+    if ble_up:
+        keyboard_outputs[output_count] = ble_keyboard
+        mouse_outputs[output_count] = ble_mouse
+        output_count += 1
+    usb_active = usb_up
+    ble_active = ble_up
+    if debug:
+        print("Output:", "USB" if usb_up else "", "BLE" if ble_up else "")
+
+# Speculation state. Every stroke teaches strokes_started/strokes_grown how
+# often the keys first seen became a different chord by minimum_hold_time,
+# speculating or not, so a chord that stopped being guessed can earn it back.
+stroke_open = False      # keys have been down since the last all-up scan
+first_mask = 0           # keys on the stroke's first scan, 0 once settled
+speculated_mask = 0      # chord typed ahead of minimum_hold_time, 0 when none
+strokes_started = bytearray(128)
+strokes_grown = bytearray(128)
+speculation_count = 0
+speculation_misses = 0
+
+def speculation_likely(mask):
+    action = active_table[mask]
+    if action >> 8 != ACT_KEY or not typing_keys[action & 0xFF]:
+        return False
+    # Layer and modifier state a correction could not restore
+    if sequence_layer is not None or once_layer is not None or oneshot_mods:
+        return False
+    if held_mods & ~SHIFT_MODS:
+        return False
+    if final_chords[mask]:
+        return True
+    started = strokes_started[mask]
+    return started >= speculate_min_strokes and strokes_grown[mask] * 100 <= started * speculate_max_wrong
+
+def speculate_chord(mask, current_time):
+    global pending_mask, last_combo_time, chord_count, speculated_mask, speculation_count
+    do_key(active_table[mask] & 0xFF, mask)
+    chord_count += 1
+    speculation_count += 1
+    speculated_mask = mask
+    pending_mask = mask
+    last_combo_time = current_time
+
+def settle_chord(mask, current_time):
+    # The stroke's chord is known: learn from it and take back a wrong guess.
+    # The chord then fires as usual; the backspace and its key go out together.
+    global first_mask, speculated_mask, pending_mask, last_combo_time, speculation_misses
+    if strokes_started[first_mask] == 255:
+        strokes_started[first_mask] >>= 1
+        strokes_grown[first_mask] >>= 1
+    strokes_started[first_mask] += 1
+    if mask != first_mask:
+        strokes_grown[first_mask] += 1
+    if speculated_mask and mask != speculated_mask:
+        speculation_misses += 1
+        send_keyboard(backspace_report)
+        send_keyboard(release_report)
+        if history_length:
+            history_pop()
+        pending_mask = 0
+    elif speculated_mask:
+        # A guess that stands counts as fired now, as it would have without
+        # speculation, so combo_time_window runs from here
+        last_combo_time = current_time
+    speculated_mask = 0
+    first_mask = 0
+
+# Chord detection, evaluated as of current_time (ticks_ms)
+def check_chords(current_time):
+    global pending_mask, last_combo_time, last_hold_time, last_release_time
+    global once_layer, momentary_layer, held_mods, chord_count, sequence_layer
+    global stroke_open, first_mask
+    if calibrating or not keys_settled:
+        return
+    if sequence_layer is not None and ticks_diff(current_time, last_combo_time) > sequence_timeout:
+        sequence_layer = None
+    # Ints and preallocated tables only: nothing on this path allocates
+    if modifier_hand is None:
+        mask = hand_masks[0] | hand_masks[1]
+        held_mods = 0
+    else:
+        mask = hand_masks[1 - modifier_hand]
+        held_mods = modifier_hand_mods[hand_masks[modifier_hand]]
+
+    # Keys holding a momentary layer are not part of the chords typed on it
+    if momentary_layer is not None:
+        if mask & momentary_mask == momentary_mask:
+            mask &= ~momentary_mask
+        else:
+            pop_layer(momentary_layer)
+            momentary_layer = None
+
+    if mask:
+        if mask != pending_mask:
+            release_chord()
+        if last_hold_time is None:
             last_hold_time = current_time
+        # The keypad backend sets last_hold_time itself, at the press event
+        if not stroke_open:
+            stroke_open = True
+            first_mask = mask
+            if (speculate and ticks_diff(current_time, last_hold_time) < minimum_hold_time
+                    and speculation_likely(mask)):
+                speculate_chord(mask, current_time)
+                return
 
-        if (current_time - last_hold_time) >= minimum_hold_time:
-            # Toggle mouse layer
-            if current_combo == mouse_trigger_chord:
-                mouse_layer_armed = not mouse_layer_armed
-                modifier_layer_armed = False
-                held_modifier = None
-                print("Mouse Layer:", "ON" if mouse_layer_armed else "OFF")
-                pending_combo = current_combo
-                last_combo_time = current_time
+        if ticks_diff(current_time, last_hold_time) >= minimum_hold_time:
+            if first_mask:
+                settle_chord(mask, current_time)
+            # Same chord still held after it fired
+            if mask == pending_mask:
+                if key_repeat.held:
+                    repeat_chord(current_time)
                 return
 
-            # Trigger modifier layer
-            if current_combo == layer_trigger_chord:
-                modifier_layer_armed = True
-                mouse_layer_armed = False
-                held_modifier = None
-                pending_combo = current_combo
-                last_combo_time = current_time
+            action = active_table[mask]
+            if sequence_layer is not None:
+                step = layer_action(sequence_layer, mask)
+                if step != ACT_NONE and step != TRANSPARENT:
+                    action = step
+            if action == ACT_NONE:
+                return
+            # A chord growing out of the previous one must land inside the window
+            if pending_mask and ticks_diff(current_time, last_combo_time) > combo_time_window:
                 return
 
-            # Mouse movement (if mouse layer active)
-            if mouse_layer_armed and current_combo != pending_combo:
-                dx, dy = 0, 0
-                if current_combo == (0,):
-                    dy = -10  # up
-                elif current_combo == (1,):
-                    dx = 10   # right
-                elif current_combo == (2,):
-                    dx = -10  # left
-                elif current_combo == (3,):
-                    dy = 10   # down
-
-                if dx or dy:
-                    mouse.move(x=dx, y=dy)
-                    pending_combo = current_combo
-                    last_combo_time = current_time
-                    time.sleep(cooldown_time)
-                    return
-
-            # Modifier stage 1: choose which mod to hold
-            if modifier_layer_armed and held_modifier is None:
-                if current_combo in modifier_chords and current_combo != pending_combo:
-                    held_modifier = modifier_chords[current_combo]
-                    pending_combo = current_combo
-                    last_combo_time = current_time
-                    return
-
-            # Modifier stage 2: mod + key
-            if modifier_layer_armed and held_modifier:
-                if current_combo in chords and current_combo != pending_combo:
-                    keyboard.press(held_modifier, chords[current_combo])
-                    keyboard.release_all()
-                    modifier_layer_armed = False
-                    held_modifier = None
-                    pending_combo = current_combo
-                    last_combo_time = current_time
-                    time.sleep(cooldown_time)
-                    return
-
-            # Normal chord
-            if not modifier_layer_armed and not mouse_layer_armed and current_combo in chords:
-                if pending_combo is None or (current_time - last_combo_time) <= combo_time_window:
-                    if current_combo != pending_combo:
-                        keyboard.press(chords[current_combo])
-                        keyboard.release_all()
-                        pending_combo = current_combo
-                        last_combo_time = current_time
-                        time.sleep(cooldown_time)
+            sequence_layer = None  # any stroke ends a sequence; a prefix starts the next
+            if once_layer is not None:
+                pop_layer(once_layer)
+                once_layer = None
+            action_handlers[action >> 8](action & 0xFF, mask)
+            chord_count += 1
+            pending_mask = mask
+            last_combo_time = current_time
     else:
-        pending_combo = None
-        last_hold_time = 0
-        last_release_time = current_time
-
-# Main loop
-while ble.connected:
-    for hand_index, mcp in enumerate(mcps):
-        base_index = hand_index * 7
-        for pin, key_index in pin_to_key_index.items():
-            # Flip finger keys (0–3) for right hand (0x21)
-            if hand_index == 1 and key_index in (0, 1, 2, 3):
-                key_index = 3 - key_index
-            index = base_index + key_index
-            pin_val = not mcp.get_pin(pin).value
-            pressed_keys[index] = pin_val
-
-    check_chords()
-    time.sleep(0.01)
+        release_chord()
+        if first_mask:
+            settle_chord(first_mask, current_time)  # released early: a guess stands
+        stroke_open = False
+        if last_hold_time is not None:
+            last_release_time = current_time
+        pending_mask = 0
+        last_hold_time = None
+
+# Calibration session state. While it runs no chords are sent: every key
+# transition is recorded against the current prompt instead.
+calibrating = False
+cal_prompt = -1       # prompt being typed; -1 while waiting for all keys up
+cal_trials = []
+cal_events = []
+cal_masks = [0, 0]    # key state last recorded
+cal_taps = 0
+cal_start = 0
+
+def start_calibration():
+    global calibrating, cal_prompt, cal_trials, cal_events
+    calibrating = True
+    cal_prompt = -1
+    cal_trials = []
+    cal_events = []
+    cal_masks[0] = hand_masks[0]
+    cal_masks[1] = hand_masks[1]
+    gc.enable()  # the session and fit allocate freely
+    print("Calibration: type each prompted chord, then release all keys")
+
+def next_prompt(current_time):
+    global cal_prompt, cal_events, cal_taps, cal_start
+    cal_prompt += 1
+    if cal_prompt == len(calibration_prompts):
+        finish_calibration()
+        return
+    combo, taps = calibration_prompts[cal_prompt]
+    cal_events = []
+    cal_taps = 0
+    cal_start = current_time
+    print("Calibrate %d/%d: %s x%d" % (cal_prompt + 1, len(calibration_prompts), combo, taps))
+
+def record_keys(current_time):
+    # Log key transitions since the last call as (ms since prompt, key, pressed)
+    global cal_taps
+    changed = False
+    for hand in range(2):
+        diff = hand_masks[hand] ^ cal_masks[hand]
+        for bit in range(7):
+            if diff & (1 << bit):
+                cal_events.append((ticks_diff(current_time, cal_start), hand * 7 + bit,
+                                   bool(hand_masks[hand] & (1 << bit))))
+        if diff:
+            cal_masks[hand] = hand_masks[hand]
+            changed = True
+    if not changed or cal_masks[0] | cal_masks[1]:
+        return
+    # All keys up: the tap is over
+    if cal_prompt < 0:
+        next_prompt(current_time)
+        return
+    cal_taps += 1
+    combo, taps = calibration_prompts[cal_prompt]
+    if cal_taps == taps:
+        cal_trials.append((chord_mask(combo), taps, cal_events))
+        next_prompt(current_time)
+
+def finish_calibration():
+    global calibrating, cal_trials, cal_events, pending_mask, last_hold_time
+    print("Calibration: fitting", len(cal_trials), "chords...")
+    settings, misfires = chordfit.fit(cal_trials)
+    apply_timing(settings)
+    microcontroller.nvm[NVM_TIMING:NVM_TIMING + chordfit.SETTINGS_SIZE] = chordfit.pack_settings(settings)
+    # Trace for host-calibrate.py
+    for line in chordfit.format_trace(cal_trials):
+        print(line)
+    print("Calibrated:", settings, "misfires", misfires, "of", len(cal_trials))
+    calibrating = False
+    cal_trials = []
+    cal_events = []
+    pending_mask = 0
+    last_hold_time = None
+    gc.collect()
+    gc.disable()
+
+def scan_mcp():
+    hand_masks[0] = gpio_to_mask[0][mcp_left.gpio]
+    hand_masks[1] = gpio_to_mask[1][mcp_right.gpio]
+
+def drain_keypad_events():
+    # Replay queued events in order. The key state in force before each event
+    # is evaluated at that event's hardware timestamp, so chords resolve on
+    # real press/release times and taps between loop passes are not lost.
+    global last_hold_time
+    while keys.events.get_into(key_event):
+        event_time = key_event.timestamp
+        check_chords(event_time)
+        hand = key_event.key_number // 7
+        bit = 1 << (key_event.key_number % 7)
+        if key_event.pressed:
+            if not (hand_masks[0] | hand_masks[1]):
+                last_hold_time = event_time
+            hand_masks[hand] |= bit
+        else:
+            hand_masks[hand] &= ~bit
+        if tail_enabled:
+            tail_keys(event_time)
+        if calibrating:
+            record_keys(event_time)
+    if keys.events.overflowed:
+        # Events were dropped; resync from scratch (reset re-reports held keys)
+        keys.events.clear()
+        hand_masks[0] = 0
+        hand_masks[1] = 0
+        keys.reset()
+
+scan = drain_keypad_events if input_backend == "keypad" else scan_mcp
+
+# Control channel: framed binary requests and replies on the usb_cdc data port
+# (c7klink.py, host-link.py), enabled by boot.py. The port is read and written
+# with zero timeouts: requests are parsed as their bytes arrive and replies
+# and tail records queue in tx_buffer, so a slow or absent host never stalls a
+# scan. Records that do not fit are dropped and counted. While a transfer is
+# in flight the main loop skips its sleep to move data at full CDC speed.
+link = usb_cdc.data
+if link:
+    link.timeout = 0
+    link.write_timeout = 0
+rx_buffer = bytearray(c7klink.MAX_PAYLOAD + c7klink.FRAME_OVERHEAD)
+rx_view = memoryview(rx_buffer)
+rx_len = 0               # bytes of the current frame received so far
+rx_need = 1              # frame length once the header is in; 1 while hunting for sync
+rx_timeout = 200         # ms without a byte before a partial frame is dropped
+rx_last_time = 0         # ticks_ms of the last bytes received
+tx_buffer = bytearray(c7klink.MAX_PAYLOAD + 512)
+tx_view = memoryview(tx_buffer)
+tx_start = 0
+tx_end = 0
+tail_enabled = False
+tail_masks = bytearray(2)      # hand masks in the last REC_KEYS record
+tail_payload = bytearray(16)
+records_dropped = 0
+keymap_nvm_pending = None      # uploaded keymap waiting for an idle gap to hit nvm
+
+# Metrics, read with GET_METRICS
+scan_count = 0
+chord_count = 0
+report_count = 0
+gc_collections_total = 0
+
+def queue_frame(kind, payload, length):
+    global tx_end
+    if tx_end + length + c7klink.FRAME_OVERHEAD > len(tx_buffer):
+        return False
+    tx_end = c7klink.write_frame(tx_buffer, tx_end, kind, payload, length)
+    return True
+
+def tail_record(kind, length):
+    global records_dropped
+    if not queue_frame(kind, tail_payload, length):
+        records_dropped += 1
+
+def tail_keys(current_time):
+    if hand_masks[0] == tail_masks[0] and hand_masks[1] == tail_masks[1]:
+        return
+    tail_masks[0] = hand_masks[0]
+    tail_masks[1] = hand_masks[1]
+    tail_payload[0] = current_time & 0xFF
+    tail_payload[1] = (current_time >> 8) & 0xFF
+    tail_payload[2] = hand_masks[0]
+    tail_payload[3] = hand_masks[1]
+    tail_record(c7klink.REC_KEYS, 4)
+
+def tail_report(device, report):
+    current_time = supervisor.ticks_ms()
+    tail_payload[0] = current_time & 0xFF
+    tail_payload[1] = (current_time >> 8) & 0xFF
+    tail_payload[2] = device
+    for i in range(len(report)):
+        tail_payload[3 + i] = report[i]
+    tail_record(c7klink.REC_REPORT, 3 + len(report))
+
+def current_settings():
+    return {"minimum_hold_time": minimum_hold_time, "combo_time_window": combo_time_window,
+            "repeat_delay": key_repeat.delay}
+
+def reply(request, payload):
+    if not queue_frame(request | c7klink.REPLY, payload, len(payload)):
+        reply_error(request, c7klink.ERR_BUSY)
+
+def reply_error(request, code):
+    # Errors are tiny; if even one does not fit, the host times out instead
+    queue_frame(c7klink.ERROR, bytes((request, code)), 2)
+
+def handle_request(request, length):
+    # Requests allocate freely: they only arrive when a host asks
+    global tail_enabled, keymap_nvm_pending
+    payload = bytes(rx_view[4:4 + length])
+    if request == c7klink.PING:
+        reply(request, bytes((c7klink.PROTOCOL_VERSION,)))
+    elif request == c7klink.GET_KEYMAP:
+        if keymap_length > c7klink.MAX_PAYLOAD:
+            reply_error(request, c7klink.ERR_TOO_LARGE)  # the host would drop it
+        else:
+            keymap = keymap_store[keymap_base:keymap_base + keymap_length]
+            reply(request, c7kmap.with_settings(keymap, current_settings()))
+    elif request == c7klink.PUT_KEYMAP:
+        if not payload:
+            keymap_nvm_pending = bytes(c7kmap.HEADER_SIZE)  # clears the magic
+            reply(request, b"")
+        elif load_keymap(payload):
+            keymap_nvm_pending = payload
+            reply(request, b"")
+        else:
+            reply_error(request, c7klink.ERR_BAD_KEYMAP)
+    elif request == c7klink.GET_METRICS:
+        reply(request, c7klink.pack_u32((
+            supervisor.ticks_ms(), scan_count, chord_count, report_count,
+            gc_collections_total, gc.mem_free(), gc.mem_alloc(), records_dropped,
+            boot_ready_ms, first_report_uptime(), keymap_ram(),
+            speculation_count, speculation_misses)))
+    elif request == c7klink.TAIL:
+        tail_enabled = length > 0 and payload[0] != 0
+        tail_masks[0] = 0
+        tail_masks[1] = 0
+        reply(request, b"")
+    else:
+        reply_error(request, c7klink.ERR_UNKNOWN)
+
+def link_receive():
+    global rx_len, rx_need
+    while link.in_waiting:
+        count = link.readinto(rx_view[rx_len:rx_need])
+        if not count:
+            return
+        if rx_len == 0 and rx_buffer[0] != c7klink.SYNC:
+            continue  # not a frame start; keep hunting
+        rx_len += count
+        if rx_len == 1:
+            rx_need = 4
+        elif rx_len == 4:
+            length = rx_buffer[2] | (rx_buffer[3] << 8)
+            if length > c7klink.MAX_PAYLOAD:
+                reply_error(rx_buffer[1], c7klink.ERR_TOO_LARGE)
+                rx_len = 0
+                rx_need = 1
+            else:
+                rx_need = length + c7klink.FRAME_OVERHEAD
+        elif rx_len == rx_need:
+            length = rx_need - c7klink.FRAME_OVERHEAD
+            if c7klink.checksum(rx_buffer, 1, rx_need - 1) == rx_buffer[rx_need - 1]:
+                handle_request(rx_buffer[1], length)
+            else:
+                reply_error(rx_buffer[1], c7klink.ERR_BAD_FRAME)
+            rx_len = 0
+            rx_need = 1
+
+def link_send():
+    global tx_start, tx_end, tail_enabled
+    if not link.connected:
+        # Nobody is listening: drop queued output rather than let it pile up
+        tx_start = 0
+        tx_end = 0
+        tail_enabled = False
+        return
+    while tx_start < tx_end:
+        count = link.write(tx_view[tx_start:tx_end])
+        if not count:
+            break
+        tx_start += count
+    if tx_start == tx_end:
+        tx_start = 0
+        tx_end = 0
+    elif tx_start > len(tx_buffer) // 2:
+        # Slow host: slide the unsent tail down to make room
+        tx_buffer[0:tx_end - tx_start] = tx_view[tx_start:tx_end]
+        tx_end -= tx_start
+        tx_start = 0
+
+def link_tasks(current_time):
+    # Returns True while a transfer is in flight
+    global rx_len, rx_need, rx_last_time
+    if not link:
+        return False
+    if link.in_waiting:
+        link_receive()
+        rx_last_time = current_time
+    elif rx_len and (not link.connected or ticks_diff(current_time, rx_last_time) > rx_timeout):
+        # The host stopped or went away mid-frame: drop the partial frame so
+        # the next request parses and the main loop can sleep again
+        rx_len = 0
+        rx_need = 1
+    if tail_enabled:
+        tail_keys(current_time)
+    if tx_end:
+        link_send()
+    return rx_len > 0 or tx_end > 0
+
+# Garbage collection. The scan path allocates nothing, so the automatic
+# collector is switched off and gc.collect() runs only in idle gaps, once all
+# keys have been up for gc_idle_time and something was allocated since the
+# last collection. Nothing is typed during an idle gap, so the pause is never
+# inside a chord. With the collector disabled the VM does not collect on a
+# failed allocation either, it raises MemoryError, and some things still
+# allocate outside idle gaps (control channel requests, link_send's slices
+# while tailing, library internals). So as a safety net the main loop checks
+# the free heap every gc_check_scans passes and collects at once below
+# gc_free_floor, keys held or not.
+gc_idle_time = 300          # ms with all keys up before collecting
+gc_check_scans = 100        # passes between free-heap checks
+gc_free_floor = 8192        # bytes; collect immediately below this
+heap_report_interval = 60000  # ms between heap reports, 0 to disable
+gc_collections = 0          # collections since the last heap report
+gc_alloc_after_collect = 0
+last_heap_report = 0
+
+def gc_safety_net():
+    global gc_collections, gc_collections_total, gc_alloc_after_collect
+    if gc.mem_free() < gc_free_floor:
+        gc.collect()
+        gc_collections += 1
+        gc_collections_total += 1
+        gc_alloc_after_collect = gc.mem_alloc()
+
+# Keymap file: layer tables and timing compiled by host-keymap.py into the
+# c7kmap format. Copy it to CIRCUITPY and it replaces the built-in layers above,
+# at boot and again whenever the file changes, without a reboot. Hot reload
+# turns off CircuitPython's autoreload, so after editing code.py itself press
+# reset (or Ctrl-D in the serial console).
+keymap_path = "/keymap.bin"
+keymap_hot_reload = True
+keymap_poll_interval = 1000  # ms between checks for a changed keymap file
+keymap_stamp = None          # (size, mtime) of the keymap last loaded
+last_keymap_poll = 0
+
+if keymap_hot_reload:
+    supervisor.runtime.autoreload = False
+
+def load_keymap(data, store=None, base=0):
+    # Check the whole keymap, then switch to it between two scans. It is read
+    # in place from then on: from data, or from the same bytes at base in
+    # store (microcontroller.nvm), so data can be a temporary copy.
+    global keymap_store, keymap_base, keymap_length, keymap_layers, keymap_text_offsets
+    global once_layer, momentary_layer, momentary_mask, oneshot_mods, sequence_layer
+    count = c7kmap.layer_count(data)
+    offsets = c7kmap.text_offsets(data, count) if count else None
+    if offsets is None:
+        print("Keymap: invalid, keeping the current one")
+        return False
+    for i in range(c7kmap.HEADER_SIZE, c7kmap.HEADER_SIZE + c7kmap.LAYER_SIZE * count, 2):
+        action = data[i] | (data[i + 1] << 8)
+        kind = action >> 8
+        arg = action & 0xFF
+        if action != TRANSPARENT and (kind >= len(action_handlers)
+                or (kind == ACT_NONE and arg)
+                or ((ACT_TOGGLE <= kind <= ACT_ONCE or kind == ACT_SEQUENCE) and arg >= count)
+                or (kind == ACT_TEXT and arg >= len(offsets))
+                or (kind == ACT_MOUSE and arg >= len(mouse_move_reports))
+                or (kind == ACT_HOST and arg >= host_slots)):
+            print("Keymap: bad action 0x%04x, keeping the current one" % action)
+            return False
+    settings = c7kmap.unpack_settings(data)
+    release_chord()
+    apply_timing(settings)
+    keymap_store = data if store is None else store
+    keymap_base = base
+    keymap_length = len(data)
+    keymap_layers = count
+    keymap_text_offsets = offsets
+    layer_stack[:] = [BASE]
+    once_layer = None
+    momentary_layer = None
+    momentary_mask = 0
+    oneshot_mods = 0
+    sequence_layer = None
+    rebuild_active_table()
+    print("Keymap:", count, "layers,", len(offsets), "texts,", len(settings), "settings,",
+          "in flash," if store is microcontroller.nvm else "in RAM,", keymap_ram(), "bytes resident")
+    return True
+
+def poll_keymap(at_boot=False):
+    global keymap_stamp, keymap_nvm_pending
+    try:
+        stat = os.stat(keymap_path)
+    except OSError:
+        return
+    stamp = (stat[6], stat[8])
+    if stamp == keymap_stamp:
+        return
+    try:
+        with open(keymap_path, "rb") as keymap_file:
+            data = keymap_file.read()
+    except OSError:
+        return
+    # A file still being copied fails the checksum; it is retried next poll
+    if load_keymap(data):
+        keymap_stamp = stamp
+        # A file copied after boot is newer than any uploaded keymap: drop
+        # that one so the file still wins after a reset
+        if not at_boot and c7kmap.keymap_size(microcontroller.nvm[NVM_KEYMAP:NVM_KEYMAP + c7kmap.HEADER_SIZE]):
+            keymap_nvm_pending = bytes(c7kmap.HEADER_SIZE)
+
+def idle_tasks(current_time):
+    global gc_collections, gc_collections_total, gc_alloc_after_collect, last_heap_report
+    global last_keymap_poll, keymap_nvm_pending, keymap_store, keymap_base
+    if hand_masks[0] | hand_masks[1] or last_hold_time is not None:
+        return
+    if ticks_diff(current_time, last_release_time) < gc_idle_time:
+        return
+    # Flash writes stall the CPU, so the host slot is saved in an idle gap
+    if microcontroller.nvm[NVM_HOST_SLOT] != active_host:
+        microcontroller.nvm[NVM_HOST_SLOT] = active_host
+    if keymap_nvm_pending is not None:
+        if keymap_store is microcontroller.nvm:
+            # About to be overwritten: keep running from a RAM copy
+            keymap_store = bytes(keymap_store[keymap_base:keymap_base + keymap_length])
+            keymap_base = 0
+        microcontroller.nvm[NVM_KEYMAP:NVM_KEYMAP + len(keymap_nvm_pending)] = keymap_nvm_pending
+        if keymap_store is keymap_nvm_pending:
+            # Run the uploaded keymap from flash and free its RAM
+            keymap_store = microcontroller.nvm
+            keymap_base = NVM_KEYMAP
+            print("Keymap: stored, in flash,", keymap_ram(), "bytes resident")
+        keymap_nvm_pending = None
+    if keymap_hot_reload and ticks_diff(current_time, last_keymap_poll) >= keymap_poll_interval:
+        poll_keymap()
+        last_keymap_poll = current_time
+    if gc.mem_alloc() > gc_alloc_after_collect:
+        gc.collect()
+        gc_collections += 1
+        gc_collections_total += 1
+        gc_alloc_after_collect = gc.mem_alloc()
+    if first_report_ticks is not None and boot_marks[-1][0] != "first report":
+        boot_marks.append(("first report", first_report_uptime()))
+        print("Boot (ms since reset):", ", ".join("%s %d" % mark for mark in boot_marks))
+    if heap_report_interval and ticks_diff(current_time, last_heap_report) >= heap_report_interval:
+        print("Heap: free", gc.mem_free(), "used", gc.mem_alloc(),
+              "collections/min", gc_collections * 60000 // heap_report_interval)
+        if speculate:
+            print("Speculation:", speculation_count, "guesses,",
+                  speculation_misses * 100 // max(speculation_count, 1), "% wrong")
+        gc_collections = 0
+        last_heap_report = current_time
+
+def hot_path_selftest(passes=200):
+    # Run scan + chord resolution with the collector off and report how many
+    # bytes it allocated; anything above 0 means the hot path regressed.
+    # After the idle scans, a key chord is typed over and over through
+    # hand_masks on a synthetic clock (press, hold into repeat, release) with
+    # no output live, so resolution, the handlers, the reports, repeat and
+    # the undo history are all measured. Run at boot, before any key is pressed.
+    global output_count, report_count, first_report_ticks, chord_count
+    global speculation_count, speculation_misses, last_release_time, usb_active, ble_active
+    update_outputs()  # settle the route (and start advertising) first
+    mask = 1
+    while mask < 127 and active_table[mask] >> 8 != ACT_KEY:
+        mask += 1
+    saved = (report_count, first_report_ticks, chord_count,
+             speculation_count, speculation_misses, last_release_time)
+    gc.collect()
+    before = gc.mem_alloc()
+    for _ in range(passes):
+        update_outputs()
+        scan()
+        check_chords(supervisor.ticks_ms())
+    output_count = 0
+    current_time = supervisor.ticks_ms()
+    for i in range(passes):
+        current_time = (current_time + 10) & TICKS_MAX
+        hand_masks[0] = mask if i % 50 < 40 else 0  # 400 ms down, 100 ms up
+        check_chords(current_time)
+    allocated = gc.mem_alloc() - before
+    hand_masks[0] = 0
+    check_chords(current_time)
+    # A transport may have come up meanwhile: rebuild the route from scratch
+    usb_active = False
+    ble_active = False
+    update_outputs()
+    (report_count, first_report_ticks, chord_count,
+     speculation_count, speculation_misses, last_release_time) = saved
+    history_clear()
+    strokes_started[mask] = 0
+    strokes_grown[mask] = 0
+    print("Hot path:", allocated, "bytes allocated over", 2 * passes, "scans",
+          "(OK)" if allocated == 0 else "(FAIL)")
+    return allocated
+
+def wait_for_keys_up():
+    # Keys still held through reset, e.g. a boot.py mode chord, must not type:
+    # scan without resolving chords until every key has been up once
+    global keys_settled, last_hold_time
+    scan()
+    if hand_masks[0] | hand_masks[1]:
+        print("Boot: waiting for all keys to be released")
+    while hand_masks[0] | hand_masks[1]:
+        time.sleep(0.01)
+        scan()
+    last_hold_time = None
+    keys_settled = True
+
+poll_keymap(at_boot=True)
+# A keymap uploaded over the control channel is newer than the file (a file
+# changed after the upload clears it, see poll_keymap)
+nvm_keymap_size = c7kmap.keymap_size(microcontroller.nvm[NVM_KEYMAP:NVM_KEYMAP + c7kmap.HEADER_SIZE])
+if nvm_keymap_size and NVM_KEYMAP + nvm_keymap_size <= len(microcontroller.nvm):
+    load_keymap(microcontroller.nvm[NVM_KEYMAP:NVM_KEYMAP + nvm_keymap_size],
+                microcontroller.nvm, NVM_KEYMAP)
+gc.collect()
+gc.disable()
+wait_for_keys_up()
+if selftest:
+    hot_path_selftest()
+last_heap_report = supervisor.ticks_ms()
+boot_ready_ms = uptime_ms()
+boot_marks.append(("ready", boot_ready_ms))
+
+# Main loop. Scanning never waits on a transport: BLE advertises and
+# reconnects in the background and reports follow whichever hosts are up.
+while True:
+    update_outputs()
+    scan()
+    scan_count += 1
+    now = supervisor.ticks_ms()
+    if calibrating:
+        record_keys(now)
+    check_chords(now)
+    idle_tasks(now)
+    if scan_count % gc_check_scans == 0:
+        gc_safety_net()
+    if not link_tasks(now):
+        time.sleep(0.01)
@@ -1,23 +1,22 @@
 import board
-import busio
 import time
 import digitalio
+import supervisor
+from c7kboard import ticks_diff, wait_for_i2c, KeyRepeat
 from adafruit_mcp230xx.mcp23008 import MCP23008
 import adafruit_ble
 from adafruit_ble.advertising.standard import ProvideServicesAdvertisement
 from adafruit_ble.services.standard.hid import HIDService
 from adafruit_hid.keyboard import Keyboard
 from adafruit_hid.keycode import Keycode
-from adafruit_hid.mouse import Mouse
 
 # --- Turn on external VCC (P0.13 high) ---
 vcc_enable = digitalio.DigitalInOut(board.VCC_OFF)
 vcc_enable.direction = digitalio.Direction.OUTPUT
 vcc_enable.value = True
-time.sleep(0.5)
 
 # Setup I2C and single MCP23008 expander
-i2c = busio.I2C(scl=board.SCL, sda=board.SDA, frequency=400000)
+i2c = wait_for_i2c((0x20,))
 mcp = MCP23008(i2c)
 
 # Configure pins 0–6 as inputs with pull-ups
@@ -25,13 +24,14 @@ pins = [mcp.get_pin(i) for i in range(7)]
 for pin in pins:
     pin.direction = digitalio.Direction.INPUT
     pin.pull = digitalio.Pull.UP
+inputs_ready_ms = time.monotonic_ns() // 1000000
 
 # BLE HID setup
 ble = adafruit_ble.BLERadio()
 hid = HIDService()
 advertisement = ProvideServicesAdvertisement(hid)
 keyboard = Keyboard(hid.devices)
-mouse = Mouse(hid.devices)
+mouse = None  # adafruit_hid.mouse is imported the first time the mouse layer is used
 
 # Map MCP pin → key index (0–6)
 pin_to_key_index = {i: i for i in range(7)}
@@ -40,18 +40,42 @@ pin_to_key_index = {i: i for i in range(7)}
 pressed_keys = [False] * 7
 pending_combo = None
 last_combo_time = 0
-last_hold_time = 0
-last_release_time = 0
+last_hold_time = None
+last_release_time = None
 
-# Timing params
-minimum_hold_time   = 0.01
-combo_time_window   = 0.01
+# Timing params (ms, except cooldown_time which is passed to time.sleep)
+minimum_hold_time   = 10
+combo_time_window   = 10
 cooldown_time       = 0.01
-release_time_window = 0.01
+release_time_window = 10
+
+# Repeat while a chord is held: "host", "firmware" or None, see c7kboard.KeyRepeat
+key_repeat = KeyRepeat(mode="host", delay=300, min_interval=30, acceleration=20)
+repeat_keycodes = None        # keycodes of the chord being held/repeated
+
+def press_chord(*keycodes):
+    # Send a newly detected chord and arm repeat for it
+    global repeat_keycodes
+    keyboard.press(*keycodes)
+    if key_repeat.press():
+        keyboard.release_all()
+    repeat_keycodes = keycodes
+
+def release_chord():
+    # The held chord changed or was released: stop repeating it
+    if key_repeat.release():
+        keyboard.release_all()
+
+def repeat_chord(current_time):
+    # Firmware repeat for a chord that is still held; host repeat needs nothing
+    global last_combo_time
+    if key_repeat.due(current_time, last_combo_time):
+        keyboard.press(*repeat_keycodes)
+        keyboard.release_all()
+        last_combo_time = current_time
 
 # Modifier layer
 modifier_layer_armed = False
-held_modifier        = None
 layer_trigger_chord  = (5, 6)
 modifier_chords = {
     (0,): Keycode.LEFT_SHIFT,
@@ -60,6 +84,25 @@ modifier_chords = {
     (3,): Keycode.LEFT_GUI
 }
 
+# One-shot (sticky) modifiers. Any set of modifier fingers chorded together
+# with layer_trigger_chord arms those modifiers for the next key chord in a
+# single stroke, e.g. (1,5,6) then (0,3) sends Ctrl+C. They stack until used:
+# (0,5,6) then (1,5,6), or (0,1,5,6) at once, gives Shift+Ctrl.
+# With the modifier layer armed, the fingers alone do the same.
+oneshot_mods = []
+modifier_combos = {}  # finger chord → modifiers, e.g. (0,1) → (SHIFT, CONTROL)
+oneshot_chords  = {}  # finger chord + layer_trigger_chord → modifiers
+for bits in range(1, 1 << len(modifier_chords)):
+    fingers = tuple(f for f in range(len(modifier_chords)) if bits & (1 << f))
+    mods = tuple(modifier_chords[(f,)] for f in fingers)
+    modifier_combos[fingers] = mods
+    oneshot_chords[fingers + layer_trigger_chord] = mods
+
+def arm_oneshot(mods):
+    for mod in mods:
+        if mod not in oneshot_mods:
+            oneshot_mods.append(mod)
+
 # Mouse layer
 mouse_layer_armed  = False
 mouse_trigger_chord = (4, 5)
@@ -111,30 +154,50 @@ ble.stop_advertising()
 
 def check_chords():
     global pending_combo, last_combo_time, last_hold_time, last_release_time
-    global modifier_layer_armed, held_modifier, mouse_layer_armed
+    global modifier_layer_armed, mouse_layer_armed, oneshot_mods, mouse
 
-    current_time = time.monotonic()
+    current_time = supervisor.ticks_ms()
     combo = tuple(i for i, down in enumerate(pressed_keys) if down)
 
     if combo:
-        if last_hold_time == 0:
+        if combo != pending_combo:
+            release_chord()
+        if last_hold_time is None:
             last_hold_time = current_time
 
-        if (current_time - last_hold_time) >= minimum_hold_time:
+        if ticks_diff(current_time, last_hold_time) >= minimum_hold_time:
+            # 0) Same chord still held after it fired
+            if combo == pending_combo and key_repeat.held:
+                repeat_chord(current_time)
+                return
+
             # 1) Toggle mouse layer
             if combo == mouse_trigger_chord:
+                if mouse is None:
+                    from adafruit_hid.mouse import Mouse
+                    mouse = Mouse(hid.devices)
                 mouse_layer_armed    = not mouse_layer_armed
                 modifier_layer_armed = False
-                held_modifier        = None
+                oneshot_mods         = []
                 pending_combo        = combo
                 last_combo_time      = current_time
                 return
 
-            # 2) Arm modifier layer
-            if combo == layer_trigger_chord:
+            # 2) Arm modifier layer, but not again while it is held or when it
+            #    is what is left of a rolled one-shot chord being lifted
+            if (combo == layer_trigger_chord and combo != pending_combo
+                    and not (pending_combo and set(combo) < set(pending_combo))):
                 modifier_layer_armed = True
                 mouse_layer_armed    = False
-                held_modifier        = None
+                pending_combo        = combo
+                last_combo_time      = current_time
+                return
+
+            # 2b) One-shot modifier chord (fingers + layer_trigger_chord)
+            if combo in oneshot_chords and combo != pending_combo:
+                arm_oneshot(oneshot_chords[combo])
+                modifier_layer_armed = False  # rolled in through layer_trigger_chord
+                mouse_layer_armed    = False
                 pending_combo        = combo
                 last_combo_time      = current_time
                 return
@@ -153,42 +216,36 @@ def check_chords():
                     time.sleep(cooldown_time)
                     return
 
-            # 4) Pick a modifier
-            if modifier_layer_armed and held_modifier is None:
-                if combo in modifier_chords and combo != pending_combo:
-                    held_modifier    = modifier_chords[combo]
-                    pending_combo    = combo
-                    last_combo_time  = current_time
-                    return
-
-            # 5) Modifier + key
-            if modifier_layer_armed and held_modifier:
-                if combo in chords and combo != pending_combo:
-                    keyboard.press(held_modifier, chords[combo])
-                    keyboard.release_all()
+            # 4) Pick modifiers on the armed layer; they apply to the next chord
+            if modifier_layer_armed:
+                if combo in modifier_combos and combo != pending_combo:
+                    arm_oneshot(modifier_combos[combo])
                     modifier_layer_armed = False
-                    held_modifier        = None
                     pending_combo        = combo
                     last_combo_time      = current_time
-                    time.sleep(cooldown_time)
-                    return
+                return
 
-            # 6) Normal chord
-            if (not modifier_layer_armed) and (not mouse_layer_armed) and combo in chords:
-                if pending_combo is None or (current_time - last_combo_time) <= combo_time_window:
+            # 5) Normal chord, with any one-shot modifiers in the same report
+            if (not mouse_layer_armed) and combo in chords:
+                if pending_combo is None or ticks_diff(current_time, last_combo_time) <= combo_time_window:
                     if combo != pending_combo:
-                        keyboard.press(chords[combo])
-                        keyboard.release_all()
+                        press_chord(*(oneshot_mods + [chords[combo]]))
+                        oneshot_mods    = []
                         pending_combo   = combo
                         last_combo_time = current_time
                         time.sleep(cooldown_time)
     else:
         # all keys released → reset
-        if last_release_time == 0 or (current_time - last_release_time) >= release_time_window:
+        release_chord()
+        if last_release_time is None or ticks_diff(current_time, last_release_time) >= release_time_window:
             pending_combo   = None
-            last_hold_time  = 0
+            last_hold_time  = None
             last_release_time = current_time
 
+# Startup time, ms since reset: until the keys can be read, and until typing
+# can start (the BLE connection included)
+print("Boot: inputs", inputs_ready_ms, "ms, connected", time.monotonic_ns() // 1000000, "ms")
+
 # Main loop: sample pins and run chord logic
 while ble.connected:
     for pin, idx in pin_to_key_index.items():
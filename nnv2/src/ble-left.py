@@ -1,7 +1,8 @@
 import board
-import busio
 import time
 import digitalio
+import supervisor
+from c7kboard import ticks_diff, wait_for_i2c, KeyRepeat
 from adafruit_mcp230xx.mcp23008 import MCP23008
 import adafruit_ble
 from adafruit_ble.advertising.standard import ProvideServicesAdvertisement
@@ -14,11 +15,8 @@ vcc_enable = digitalio.DigitalInOut(board.VCC_OFF)
 vcc_enable.direction = digitalio.Direction.OUTPUT
 vcc_enable.value = True
 
-# Optional: let power stabilize
-time.sleep(0.5)
-
 # Setup I2C for MCP23008
-i2c = busio.I2C(scl=board.SCL, sda=board.SDA, frequency=400000)
+i2c = wait_for_i2c((0x20,))
 mcp = MCP23008(i2c)
 
 # Set up MCP23017 pins as inputs with pull-ups
@@ -26,6 +24,7 @@ pins = [mcp.get_pin(i) for i in range(7)]
 for pin in pins:
     pin.direction = digitalio.Direction.INPUT
     pin.pull = digitalio.Pull.UP
+inputs_ready_ms = time.monotonic_ns() // 1000000
 
 # Initialize BLE and HID services
 ble = adafruit_ble.BLERadio()
@@ -48,14 +47,39 @@ pin_to_key_index = {
 pressed_keys = [False] * 7  # 7 keys mapped from MCP23017 (indexed 0-6)
 pending_combo = None
 last_combo_time = 0
-last_hold_time = 0
-last_release_time = 0
+last_hold_time = None
+last_release_time = None
 
 # Timing parameters
-minimum_hold_time = 0.01  # Minimum time keys must be held to register a chord (in seconds)
-combo_time_window = 0.01  # Time window for combo detection (in seconds)
-cooldown_time = 0.01      # Cooldown time to prevent accidental repeats (in seconds)
-release_time_window = 0.01 # Time window to ensure all keys are released before new detection (in seconds)
+minimum_hold_time = 10    # Minimum time keys must be held to register a chord (in ms)
+combo_time_window = 10    # Time window for combo detection (in ms)
+cooldown_time = 0.01      # Cooldown time to prevent accidental repeats (in seconds, for time.sleep)
+release_time_window = 10  # Time window to ensure all keys are released before new detection (in ms)
+
+# Repeat while a chord is held: "host", "firmware" or None, see c7kboard.KeyRepeat
+key_repeat = KeyRepeat(mode="host", delay=300, min_interval=30, acceleration=20)
+repeat_keycodes = None        # keycodes of the chord being held/repeated
+
+def press_chord(*keycodes):
+    # Send a newly detected chord and arm repeat for it
+    global repeat_keycodes
+    keyboard.press(*keycodes)
+    if key_repeat.press():
+        keyboard.release_all()
+    repeat_keycodes = keycodes
+
+def release_chord():
+    # The held chord changed or was released: stop repeating it
+    if key_repeat.release():
+        keyboard.release_all()
+
+def repeat_chord(current_time):
+    # Firmware repeat for a chord that is still held; host repeat needs nothing
+    global last_combo_time
+    if key_repeat.due(current_time, last_combo_time):
+        keyboard.press(*repeat_keycodes)
+        keyboard.release_all()
+        last_combo_time = current_time
 
 # Define chord mappings from the original zibn.py
 chords = {
@@ -94,30 +118,39 @@ ble.stop_advertising()
 def check_chords():
     global pending_combo, last_combo_time, last_hold_time, last_release_time
     current_combo = tuple(i for i, pressed in enumerate(pressed_keys) if pressed)
-    current_time = time.monotonic()
+    current_time = supervisor.ticks_ms()
 
     if current_combo:
+        if current_combo != pending_combo:
+            release_chord()
+
         # Check if the keys are held for the minimum required time
-        if last_hold_time == 0:
+        if last_hold_time is None:
             last_hold_time = current_time
 
-        if (current_time - last_hold_time) >= minimum_hold_time:
-            if current_combo in chords:
+        if ticks_diff(current_time, last_hold_time) >= minimum_hold_time:
+            if current_combo == pending_combo:
+                repeat_chord(current_time)
+            elif current_combo in chords:
                 # Ensure keys are pressed within a short time window
-                if pending_combo is None or (current_time - last_combo_time) <= combo_time_window:
+                if pending_combo is None or ticks_diff(current_time, last_combo_time) <= combo_time_window:
                     if pending_combo != current_combo:  # Only register if it's a new combo
-                        keyboard.press(chords[current_combo])
-                        keyboard.release_all()
+                        press_chord(chords[current_combo])
                         pending_combo = current_combo
                         last_combo_time = current_time
                         time.sleep(cooldown_time)  # Cooldown to prevent accidental repeats
     else:
         # Reset pending combo and hold time when all keys are released
-        if last_release_time == 0 or (current_time - last_release_time) >= release_time_window:
+        release_chord()
+        if last_release_time is None or ticks_diff(current_time, last_release_time) >= release_time_window:
             pending_combo = None
-            last_hold_time = 0
+            last_hold_time = None
             last_release_time = current_time
 
+# Startup time, ms since reset: until the keys can be read, and until typing
+# can start (the BLE connection included)
+print("Boot: inputs", inputs_ready_ms, "ms, connected", time.monotonic_ns() // 1000000, "ms")
+
 # Main loop to monitor MCP23017 pin presses
 while ble.connected:
     for pin, index in pin_to_key_index.items():
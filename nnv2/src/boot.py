@@ -0,0 +1,73 @@
+import board
+import busio
+import digitalio
+import microcontroller
+import supervisor
+import time
+import usb_cdc
+import usb_hid
+import usb_midi
+from c7kboard import ticks_diff
+
+# Power-on mode for ble-both.py: hold a chord on the left hand (MCP23008 at 0x20)
+# while plugging in or pressing reset.
+#   key 4        "usb"  - USB only; the BLE stack is not even imported
+#   key 6        "ble"  - BLE only; USB HID is turned off (serial and drive stay)
+#   keys 4 + 6   "both" - USB and BLE at once
+#   nothing      output_mode as set in code.py
+# The pick lasts for this boot and reaches code.py in an nvm byte.
+boot_chords = {1 << 4: 1, 1 << 6: 2, (1 << 4) | (1 << 6): 3}  # index into code.py's boot_modes
+NVM_BOOT_MODE = 1
+NO_BOOT_MODE = 0xFF
+LEFT_MCP = 0x20
+MCP_GPPU = 0x06  # pull-up register
+MCP_GPIO = 0x09
+
+def read_left_hand(timeout=200):
+    # Logical key bitmask held on the left hand (pin n = key n, active low),
+    # 0 if the expander does not answer within timeout ms
+    vcc_enable = digitalio.DigitalInOut(board.VCC_OFF)
+    vcc_enable.direction = digitalio.Direction.OUTPUT
+    vcc_enable.value = True
+    start = supervisor.ticks_ms()
+    keys = 0
+    while ticks_diff(supervisor.ticks_ms(), start) < timeout:
+        try:
+            i2c = busio.I2C(scl=board.SCL, sda=board.SDA)
+        except RuntimeError:
+            time.sleep(0.002)  # bus pull-ups not powered yet
+            continue
+        while not i2c.try_lock():
+            pass
+        try:
+            i2c.writeto(LEFT_MCP, bytes((MCP_GPPU, 0xFF)))
+            gpio = bytearray(1)
+            i2c.writeto_then_readfrom(LEFT_MCP, bytes((MCP_GPIO,)), gpio)
+            keys = ~gpio[0] & 0x7F
+        except OSError:
+            keys = None  # no answer yet
+        i2c.unlock()
+        i2c.deinit()
+        if keys is not None:
+            break
+        keys = 0
+        time.sleep(0.002)
+    vcc_enable.deinit()
+    return keys
+
+boot_mode = boot_chords.get(read_left_hand(), NO_BOOT_MODE)
+if microcontroller.nvm[NVM_BOOT_MODE] != boot_mode:
+    microcontroller.nvm[NVM_BOOT_MODE] = boot_mode
+
+# Only the USB interfaces that are used: no MIDI, and a keyboard and mouse
+# HID device instead of the default set (none at all in BLE-only mode).
+# Fewer interfaces also enumerate faster.
+usb_midi.disable()
+if boot_mode == 2:
+    usb_hid.disable()
+else:
+    usb_hid.enable((usb_hid.Device.KEYBOARD, usb_hid.Device.MOUSE))
+
+# Keep the serial console (print output, REPL) and add a second, data-only
+# serial port for the binary control channel used by host-link.py
+usb_cdc.enable(console=True, data=True)
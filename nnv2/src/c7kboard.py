@@ -0,0 +1,85 @@
+# Tick arithmetic, key repeat and bus bring-up shared by the nnv2 keyboard
+# scripts (ble-both.py, ble-left.py, ble-left-layers.py, boot.py). Copy it
+# next to code.py.
+import board
+import busio
+import supervisor
+import time
+
+# supervisor.ticks_ms() is an integer millisecond counter that wraps at 2**29.
+# Unlike time.monotonic() it keeps full ms resolution at any uptime, as long
+# as differences are taken with ticks_diff(). keypad event timestamps use the
+# same clock.
+TICKS_PERIOD = 1 << 29
+TICKS_MAX = TICKS_PERIOD - 1
+TICKS_HALFPERIOD = TICKS_PERIOD // 2
+
+def ticks_diff(t1, t2):
+    # Signed t1 - t2 in ms, correct across wraparound
+    diff = (t1 - t2) & TICKS_MAX
+    return ((diff + TICKS_HALFPERIOD) & TICKS_MAX) - TICKS_HALFPERIOD
+
+def wait_for_i2c(addresses, timeout=1000):
+    # The expanders and the bus pull-ups run off VCC. Rather than sleeping a
+    # fixed time for it to settle, retry until the bus can be set up and
+    # every expander answers (usually a few ms), up to timeout ms.
+    start = supervisor.ticks_ms()
+    while True:
+        try:
+            bus = busio.I2C(scl=board.SCL, sda=board.SDA, frequency=400000)
+        except RuntimeError:
+            bus = None  # no pull-ups yet
+        if bus is not None:
+            while not bus.try_lock():
+                pass
+            found = bus.scan()
+            bus.unlock()
+            if all(address in found for address in addresses):
+                return bus
+            bus.deinit()
+        if ticks_diff(supervisor.ticks_ms(), start) > timeout:
+            raise RuntimeError("no MCP23008 at " + ", ".join(hex(a) for a in addresses))
+        time.sleep(0.002)
+
+class KeyRepeat:
+    # Repeat while a chord is held:
+    #   "host"     - keep the key down in the HID report and let the host OS apply
+    #                its own typematic delay and rate; a long repeat is two reports
+    #   "firmware" - re-send the key from the keyboard after delay ms, speeding up
+    #                by acceleration ms per repeat down to min_interval
+    #   None       - no repeat
+    # The script sends the reports and keeps the keys; this decides when.
+    # Nothing here allocates, so it can run on a zero-allocation scan path.
+    def __init__(self, mode="host", delay=300, min_interval=30, acceleration=20):
+        self.mode = mode
+        self.delay = delay                # ms before the first firmware repeat
+        self.min_interval = min_interval  # fastest firmware repeat (ms)
+        self.acceleration = acceleration  # ms off the interval per repeat; 0 = fixed rate
+        self.wait = delay
+        self.held = False                 # a chord went out and may repeat
+
+    def press(self):
+        # A new chord went out. True if its keys must be released at once
+        # rather than left down for the host.
+        self.held = bool(self.mode)
+        self.wait = self.delay
+        return self.mode != "host"
+
+    def release(self):
+        # The chord changed or was released. True if its keys are still down
+        # at the host and must be released now.
+        down = self.held and self.mode == "host"
+        self.held = False
+        return down
+
+    def due(self, current_time, since):
+        # True if the held chord, last sent at since (ticks_ms), must be sent
+        # again now (firmware repeat)
+        if self.mode != "firmware" or not self.held or ticks_diff(current_time, since) < self.wait:
+            return False
+        self.wait = max(self.min_interval, self.wait - self.acceleration)
+        return True
+
+    def host_repeating(self, current_time, since):
+        # True once the host may be repeating the held chord by itself
+        return self.mode == "host" and self.held and ticks_diff(current_time, since) >= self.delay
@@ -0,0 +1,76 @@
+# Binary control channel on the usb_cdc data port, shared by the keyboard
+# (copy next to code.py; boot.py enables the port) and host-link.py.
+# Every message is one frame:
+#
+#   0    1   sync 0xC7
+#   1    1   type
+#   2    2   payload length n, u16 LE, at most MAX_PAYLOAD
+#   4    n   payload
+#   4+n  1   sum of the type, length and payload bytes, & 0xFF
+#
+# The host sends requests; the keyboard answers each with a frame of type
+# request | REPLY, or ERROR. While tailing, it also sends REC_* records.
+SYNC = 0xC7
+FRAME_OVERHEAD = 5
+MAX_PAYLOAD = 4096
+
+# Requests (payload)
+PING = 0x01          # -> protocol version, u8
+GET_KEYMAP = 0x02    # -> the active keymap, c7kmap format
+PUT_KEYMAP = 0x03    # keymap -> applied at once and kept in nvm; empty clears it
+GET_METRICS = 0x04   # -> u32 LE per METRICS_NAMES
+TAIL = 0x05          # u8 1/0 starts/stops the record stream
+REPLY = 0x80
+ERROR = 0x7F         # request type, error code
+
+PROTOCOL_VERSION = 1
+ERR_BAD_FRAME = 1    # checksum
+ERR_UNKNOWN = 2      # request type not known
+ERR_BAD_KEYMAP = 3   # keymap rejected, the current one stays
+ERR_BUSY = 4         # no room for the reply, retry
+ERR_TOO_LARGE = 5    # request or reply longer than MAX_PAYLOAD
+
+# Records streamed while tailing
+REC_KEYS = 0x40      # u16 LE ms, left hand mask, right hand mask
+REC_REPORT = 0x41    # u16 LE ms, 0 keyboard / 1 mouse, report bytes
+
+METRICS_NAMES = ("uptime_ms", "scans", "chords", "reports", "gc_collections",
+                 "mem_free", "mem_alloc", "records_dropped",
+                 "boot_ready_ms", "boot_first_report_ms",  # ms since reset; 0 if not yet
+                 "keymap_ram",  # bytes the keymap keeps resident
+                 "speculations", "speculation_misses")
+
+def checksum(data, start, end):
+    total = 0
+    for i in range(start, end):
+        total += data[i]
+    return total & 0xFF
+
+def write_frame(buffer, offset, kind, payload, length):
+    # Frame payload[0:length] into buffer at offset, return the end offset.
+    # Byte loops rather than slices, so the keyboard can call it on the hot path.
+    buffer[offset] = SYNC
+    buffer[offset + 1] = kind
+    buffer[offset + 2] = length & 0xFF
+    buffer[offset + 3] = length >> 8
+    for i in range(length):
+        buffer[offset + 4 + i] = payload[i]
+    end = offset + 4 + length
+    buffer[end] = checksum(buffer, offset + 1, end)
+    return end + 1
+
+def frame(kind, payload=b""):
+    buffer = bytearray(len(payload) + FRAME_OVERHEAD)
+    write_frame(buffer, 0, kind, payload, len(payload))
+    return bytes(buffer)
+
+def pack_u32(values):
+    data = bytearray(4 * len(values))
+    for i, value in enumerate(values):
+        for b in range(4):
+            data[4 * i + b] = (value >> (8 * b)) & 0xFF
+    return bytes(data)
+
+def unpack_u32(data):
+    return [data[i] | (data[i + 1] << 8) | (data[i + 2] << 16) | (data[i + 3] << 24)
+            for i in range(0, len(data) - 3, 4)]
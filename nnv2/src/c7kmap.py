@@ -0,0 +1,163 @@
+# Binary keymap format, shared by the keyboard (copy next to code.py) and
+# host-keymap.py. A keymap is the compiled layer tables of ble-both.py plus
+# the texts its sequences type and optional timing settings, so loading one
+# is a copy, not a compile:
+#
+#   0   4      magic b"C7KM"
+#   4   1      version
+#   5   1      layer count N
+#   6   10     settings, 5 x u16 LE in chordfit.SETTINGS_NAMES order;
+#              0xFFFF leaves a setting as it is
+#   16  2      text section size T, u16 LE
+#   18  2      reserved, 0
+#   20  N*256  layer tables: 128 x u16 LE actions, indexed by chord bitmask
+#   .   T      texts: per text, a u8 character count then (modifier bits,
+#              keycode) per character
+#   end 2      u16 LE sum of all previous bytes, to reject torn writes
+from chordfit import SETTINGS_NAMES
+
+MAGIC = b"C7KM"
+VERSION = 2
+HEADER_SIZE = 20
+LAYER_SIZE = 256
+UNSET = 0xFFFF
+
+# Layer actions are small ints, (kind << 8) | argument
+ACT_NONE = 0          # nothing; also hides the layers below
+ACT_KEY = 1           # arg: keycode
+ACT_TOGGLE = 2        # arg: layer, switched on/off
+ACT_MOMENTARY = 3     # arg: layer, active while the chord's keys stay held
+ACT_ONCE = 4          # arg: layer, active for the next chord only
+ACT_ONESHOT = 5       # arg: HID modifier bits, added to the next key
+ACT_MOUSE = 6         # arg: index into mouse_moves
+ACT_HOST = 7          # arg: BLE host slot to switch to
+ACT_CALIBRATE = 8     # start a timing calibration session
+ACT_SEQUENCE = 9      # arg: layer holding the next strokes of a sequence
+ACT_TEXT = 10         # arg: index of the text to type
+ACT_UNDO = 11         # delete what the last stroke typed
+TRANSPARENT = 0xFFFF  # use whatever the layer below maps this chord to
+
+# US layout: the characters on HID keycodes 0x04-0x38, plain and shifted
+# ("\x00" where a key has nothing typeable)
+TEXT_KEYS = "abcdefghijklmnopqrstuvwxyz1234567890\n\x1b\b\t -=[]\\\x00;'`,./"
+TEXT_KEYS_SHIFTED = "ABCDEFGHIJKLMNOPQRSTUVWXYZ!@#$%^&*()\x00\x00\x00\x00\x00_+{}|\x00:\"~<>?"
+TEXT_FIRST_KEY = 0x04
+SHIFT = 0x02
+
+def encode_text(text):
+    # (modifier bits, keycode) per character
+    data = bytearray()
+    for char in text:
+        if char != "\x00" and char in TEXT_KEYS:
+            data.append(0)
+            data.append(TEXT_FIRST_KEY + TEXT_KEYS.index(char))
+        elif char != "\x00" and char in TEXT_KEYS_SHIFTED:
+            data.append(SHIFT)
+            data.append(TEXT_FIRST_KEY + TEXT_KEYS_SHIFTED.index(char))
+        else:
+            raise ValueError("cannot type %r" % char)
+    return bytes(data)
+
+def decode_text(data):
+    chars = []
+    for i in range(0, len(data), 2):
+        keys = TEXT_KEYS_SHIFTED if data[i] & SHIFT else TEXT_KEYS
+        index = data[i + 1] - TEXT_FIRST_KEY
+        chars.append(keys[index] if 0 <= index < len(keys) else "\x00")
+    return "".join(chars)
+
+def checksum(data, end):
+    total = 0
+    for i in range(end):
+        total += data[i]
+    return total & 0xFFFF
+
+def pack(tables, settings, texts=()):
+    # texts are encode_text() results
+    text_size = sum(1 + len(text) for text in texts)
+    size = HEADER_SIZE + LAYER_SIZE * len(tables) + text_size
+    data = bytearray(size + 2)
+    data[0:4] = MAGIC
+    data[4] = VERSION
+    data[5] = len(tables)
+    for i, name in enumerate(SETTINGS_NAMES):
+        value = settings.get(name, UNSET)
+        data[6 + 2 * i] = value & 0xFF
+        data[7 + 2 * i] = value >> 8
+    data[16] = text_size & 0xFF
+    data[17] = text_size >> 8
+    offset = HEADER_SIZE
+    for table in tables:
+        for action in table:
+            data[offset] = action & 0xFF
+            data[offset + 1] = action >> 8
+            offset += 2
+    for text in texts:
+        data[offset] = len(text) // 2
+        data[offset + 1:offset + 1 + len(text)] = text
+        offset += 1 + len(text)
+    seal(data)
+    return bytes(data)
+
+def seal(data):
+    # Write the checksum of a keymap in a bytearray
+    size = len(data) - 2
+    total = checksum(data, size)
+    data[size] = total & 0xFF
+    data[size + 1] = total >> 8
+
+def with_settings(data, settings):
+    # Copy of a keymap with its settings block replaced
+    data = bytearray(data)
+    for i, name in enumerate(SETTINGS_NAMES):
+        value = settings.get(name, UNSET)
+        data[6 + 2 * i] = value & 0xFF
+        data[7 + 2 * i] = value >> 8
+    seal(data)
+    return bytes(data)
+
+def keymap_size(header):
+    # Total size of the keymap starting with header, else 0
+    if len(header) < HEADER_SIZE or bytes(header[0:4]) != MAGIC or header[4] != VERSION:
+        return 0
+    return HEADER_SIZE + LAYER_SIZE * header[5] + (header[16] | (header[17] << 8)) + 2
+
+def layer_count(data):
+    # Number of layers in a valid keymap, else 0
+    size = keymap_size(data) - 2
+    if size < 0 or len(data) != size + 2 or checksum(data, size) != data[size] | (data[size + 1] << 8):
+        return 0
+    return data[5]
+
+def unpack_settings(data):
+    settings = {}
+    for i, name in enumerate(SETTINGS_NAMES):
+        value = data[6 + 2 * i] | (data[7 + 2 * i] << 8)
+        if value != UNSET:
+            settings[name] = value
+    return settings
+
+def text_offsets(data, count):
+    # Offset of each text's length byte in a keymap of count layers, or None
+    # if the text section is malformed
+    offsets = []
+    offset = HEADER_SIZE + LAYER_SIZE * count
+    end = len(data) - 2
+    while offset < end:
+        offsets.append(offset)
+        offset += 1 + 2 * data[offset]
+    return offsets if offset == end else None
+
+def unpack(data):
+    # (tables, settings, texts) from a keymap, or None if it is not valid
+    count = layer_count(data)
+    offsets = text_offsets(data, count) if count else None
+    if offsets is None:
+        return None
+    tables = []
+    offset = HEADER_SIZE
+    for _ in range(count):
+        tables.append([data[offset + 2 * i] | (data[offset + 2 * i + 1] << 8) for i in range(128)])
+        offset += LAYER_SIZE
+    texts = [bytes(data[offset + 1:offset + 1 + 2 * data[offset]]) for offset in offsets]
+    return tables, unpack_settings(data), texts
@@ -0,0 +1,165 @@
+# Chord timing calibration, shared by the keyboard (copy next to code.py)
+# and host-calibrate.py, so both fit the same parameters the same way.
+#
+# A trial is one prompted chord: (target_mask, taps, events), where events
+# are (ms since the prompt, key number 0-13, pressed) in time order. Traces
+# are text, one line per trial header or event, each prefixed with "@" so
+# they can be cut straight out of a serial console log:
+#
+#   @trial <target_mask> <taps>
+#   @<ms> <key> <1|0>
+
+# Search grid for the parameters fitted by replaying the chord engine (ms)
+HOLD_GRID = range(0, 82, 2)
+WINDOW_GRID = range(0, 65, 5)
+misfire_penalty = 500  # ms of commit latency one misfire is worth
+
+# Settings block stored in microcontroller.nvm: magic, version, 5 x u16 LE
+SETTINGS_MAGIC = b"CT"
+SETTINGS_VERSION = 1
+SETTINGS_NAMES = ("minimum_hold_time", "combo_time_window", "release_time_window",
+                  "double_press_window", "repeat_delay")
+SETTINGS_SIZE = 3 + 2 * len(SETTINGS_NAMES)
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def format_trace(trials):
+    lines = []
+    for target, taps, events in trials:
+        lines.append("@trial %d %d" % (target, taps))
+        for ms, key, pressed in events:
+            lines.append("@%d %d %d" % (ms, key, 1 if pressed else 0))
+    return lines
+
+def parse_trace(lines):
+    trials = []
+    for line in lines:
+        line = line.strip()
+        if not line.startswith("@"):
+            continue
+        fields = line[1:].split()
+        if fields[0] == "trial":
+            trials.append((int(fields[1]), int(fields[2]), []))
+        elif trials:
+            trials[-1][2].append((int(fields[0]), int(fields[1]), fields[2] == "1"))
+    return trials
+
+def simulate(events, minimum_hold_time, combo_time_window):
+    # Replay one trial through the chord engine (both hands folded, as in
+    # ble-both.py) in continuous time. Returns [(fire_ms, mask), ...].
+    fired = []
+    keys = 0
+    pending = 0
+    hold_start = None
+    last_fire = 0
+    for n in range(len(events) + 1):
+        if n:
+            ms, key, pressed = events[n - 1]
+            if pressed:
+                if not keys:
+                    hold_start = ms
+                keys |= 1 << key
+            else:
+                keys &= ~(1 << key)
+        start = events[n - 1][0] if n else 0
+        end = events[n][0] if n < len(events) else start + 1000
+        mask = (keys | (keys >> 7)) & 0x7F
+        if not mask:
+            pending = 0
+            hold_start = None
+            continue
+        if mask == pending:
+            continue
+        fire = max(start, hold_start + minimum_hold_time)
+        if fire >= end:
+            continue
+        if pending and fire - last_fire > combo_time_window:
+            continue
+        fired.append((fire, mask))
+        pending = mask
+        last_fire = fire
+    return fired
+
+def score(trials, minimum_hold_time, combo_time_window):
+    # (misfires, mean ms from the chord being fully down to its output)
+    misfires = 0
+    latency = 0
+    for target, taps, events in trials:
+        fired = simulate(events, minimum_hold_time, combo_time_window)
+        if [mask for _, mask in fired] != [target] * taps:
+            misfires += 1
+            continue
+        last_down = 0
+        for ms, key, pressed in events:
+            if pressed and ms <= fired[0][0]:
+                last_down = ms
+        latency += fired[0][0] - last_down
+    good = len(trials) - misfires
+    return misfires, latency // good if good else 0
+
+def fit(trials):
+    best = None
+    for hold in HOLD_GRID:
+        for window in WINDOW_GRID:
+            misfires, latency = score(trials, hold, window)
+            cost = misfires * misfire_penalty + latency
+            if best is None or cost < best[0]:
+                best = (cost, hold, window, misfires)
+    _, hold, window, misfires = best
+
+    release_spreads = []
+    holds = []
+    gaps = []
+    for target, taps, events in trials:
+        downs = [ms for ms, key, pressed in events if pressed]
+        ups = [ms for ms, key, pressed in events if not pressed]
+        if not downs or not ups:
+            continue
+        if taps == 1:
+            release_spreads.append(ups[-1] - ups[0])
+            holds.append(ups[0] - downs[0])
+        else:
+            # Gap between the first tap's release and the second tap's press
+            keys = 0
+            released = None
+            for ms, key, pressed in events:
+                if pressed:
+                    if released is not None and not keys:
+                        gaps.append(ms - released)
+                        break
+                    keys |= 1 << key
+                else:
+                    keys &= ~(1 << key)
+                    if not keys:
+                        released = ms
+
+    settings = {
+        "minimum_hold_time": hold,
+        "combo_time_window": window,
+        "release_time_window": max(5, percentile(release_spreads, 0.95)),
+        "double_press_window": max(150, percentile(gaps, 0.95) * 3 // 2) if gaps else 300,
+        "repeat_delay": max(150, percentile(holds, 0.99) + 50),
+    }
+    return settings, misfires
+
+def pack_settings(settings):
+    data = bytearray(SETTINGS_SIZE)
+    data[0:2] = SETTINGS_MAGIC
+    data[2] = SETTINGS_VERSION
+    for i, name in enumerate(SETTINGS_NAMES):
+        value = min(0xFFFF, settings[name])
+        data[3 + 2 * i] = value & 0xFF
+        data[4 + 2 * i] = value >> 8
+    return bytes(data)
+
+def unpack_settings(data):
+    if bytes(data[0:2]) != SETTINGS_MAGIC or data[2] != SETTINGS_VERSION:
+        return None
+    settings = {}
+    for i, name in enumerate(SETTINGS_NAMES):
+        settings[name] = data[3 + 2 * i] | (data[4 + 2 * i] << 8)
+    return settings
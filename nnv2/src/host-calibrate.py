@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# Host-side chord timing calibration. Runs the same fit as the keyboard's
+# calibration mode on trace files: serial console logs containing the "@"
+# trace lines printed at the end of a calibration session. Several logs can be
+# combined to fit on more typing than one session holds.
+#
+#   python3 host-calibrate.py session1.log session2.log
+#
+# Prints the fitted settings, ready to paste into any of the chord scripts,
+# and the nvm block the keyboard stores them as.
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import chordfit
+
+parser = argparse.ArgumentParser(description="Fit chord timing from calibration traces")
+parser.add_argument("traces", nargs="+", help="serial logs / trace files")
+parser.add_argument("--misfire-penalty", type=int, default=chordfit.misfire_penalty,
+                    help="ms of commit latency one misfire is worth (default %(default)s)")
+args = parser.parse_args()
+
+trials = []
+for path in args.traces:
+    with open(path) as trace:
+        trials.extend(chordfit.parse_trace(trace))
+if not trials:
+    sys.exit("no @trial lines found in " + ", ".join(args.traces))
+
+chordfit.misfire_penalty = args.misfire_penalty
+settings, misfires = chordfit.fit(trials)
+misfires_before, latency_before = chordfit.score(trials, 10, 10)
+misfires_after, latency_after = chordfit.score(trials, settings["minimum_hold_time"],
+                                               settings["combo_time_window"])
+
+print("# %d chords: misfires %d -> %d, commit latency %d ms -> %d ms (vs 10/10 ms defaults)"
+      % (len(trials), misfires_before, misfires_after, latency_before, latency_after))
+for name in chordfit.SETTINGS_NAMES:
+    print("%s = %d" % (name, settings[name]))
+print("# microcontroller.nvm block: %s" % chordfit.pack_settings(settings).hex())
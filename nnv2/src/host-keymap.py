@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# Host-side keymap compiler for ble-both.py. Turns a text keymap into the
+# binary c7kmap format the keyboard loads (copy it to CIRCUITPY as keymap.bin;
+# it is picked up within a second, no reboot), and turns a binary keymap back
+# into text.
+#
+#   python3 host-keymap.py keymap.txt -o keymap.bin
+#   python3 host-keymap.py --decompile keymap.bin
+#
+# Text format, one entry per line, "#" starts a comment:
+#
+#   set <setting> <ms>          e.g. set minimum_hold_time 30
+#   layer <name>                following entries go to this layer; the first
+#                               layer is the base layer
+#   <keys...> <action> [args]   keys are logical key numbers 0-6
+#
+# Actions: key <keycode>, toggle/momentary/once <layer>, oneshot <modifiers...>,
+# mouse <move>, host <slot>, calibrate, sequence <layer>, text "<string>",
+# undo, transparent, none. Keycodes and modifiers are adafruit_hid Keycode names
+# (pip install adafruit-circuitpython-hid) or numbers. A text is a Python
+# string literal typed with the US layout, and takes the rest of the line.
+#
+# A sequence is a prefix chord whose action is "sequence <layer>"; that layer
+# holds the next strokes, e.g.
+#
+#   layer base
+#   4 6 sequence briefs
+#   layer briefs
+#   2 3 text "the "
+import argparse
+import ast
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import c7kmap
+
+try:
+    from adafruit_hid.keycode import Keycode
+    keycode_names = {name: value for name, value in vars(Keycode).items()
+                     if name.isupper() and isinstance(value, int)}
+except ImportError:
+    keycode_names = {}
+# Reverse map; where Keycode has aliases (e.g. SPACE and SPACEBAR) keep the first
+keycode_values = {}
+for name, value in keycode_names.items():
+    keycode_values.setdefault(value, name)
+
+LEFT_CONTROL = 0xE0
+# "<keys...> text <literal>": the literal is the rest of the line, as written
+TEXT_ENTRY = re.compile(r"^\s*((?:\d+\s+)+)text\s+(.*?)\s*$")
+LAYER_ACTIONS = {"toggle": c7kmap.ACT_TOGGLE, "momentary": c7kmap.ACT_MOMENTARY,
+                 "once": c7kmap.ACT_ONCE}
+ACTION_NAMES = {c7kmap.ACT_KEY: "key", c7kmap.ACT_TOGGLE: "toggle",
+                c7kmap.ACT_MOMENTARY: "momentary", c7kmap.ACT_ONCE: "once",
+                c7kmap.ACT_ONESHOT: "oneshot", c7kmap.ACT_MOUSE: "mouse",
+                c7kmap.ACT_HOST: "host", c7kmap.ACT_CALIBRATE: "calibrate",
+                c7kmap.ACT_SEQUENCE: "sequence", c7kmap.ACT_TEXT: "text",
+                c7kmap.ACT_UNDO: "undo"}
+
+def keycode(name):
+    if name.upper() in keycode_names:
+        return keycode_names[name.upper()]
+    try:
+        return int(name, 0)
+    except ValueError:
+        if not keycode_names:
+            raise ValueError("unknown keycode %s (install adafruit-circuitpython-hid "
+                             "for keycode names)" % name)
+        raise ValueError("unknown keycode %s" % name)
+
+def keycode_name(value):
+    return keycode_values.get(value, "0x%02x" % value)
+
+def parse_action(words, layers, texts):
+    name = words[0]
+    args = words[1:]
+    if name == "key":
+        return (c7kmap.ACT_KEY << 8) | keycode(args[0])
+    if name in LAYER_ACTIONS or name == "sequence":
+        kind = c7kmap.ACT_SEQUENCE if name == "sequence" else LAYER_ACTIONS[name]
+        layer = layers.index(args[0]) if args[0] in layers else int(args[0])
+        return (kind << 8) | layer
+    if name == "oneshot":
+        bits = 0
+        for modifier in args:
+            bit = keycode(modifier) - LEFT_CONTROL
+            if not 0 <= bit < 8:
+                raise ValueError("%s is not a modifier" % modifier)
+            bits |= 1 << bit
+        return (c7kmap.ACT_ONESHOT << 8) | bits
+    if name == "mouse":
+        return (c7kmap.ACT_MOUSE << 8) | int(args[0])
+    if name == "host":
+        return (c7kmap.ACT_HOST << 8) | int(args[0])
+    if name == "text":
+        if len(texts) > 0xFF:
+            raise ValueError("more than 256 texts")
+        texts.append(c7kmap.encode_text(ast.literal_eval(args[0])))
+        return (c7kmap.ACT_TEXT << 8) | (len(texts) - 1)
+    if name == "calibrate":
+        return c7kmap.ACT_CALIBRATE << 8
+    if name == "undo":
+        return c7kmap.ACT_UNDO << 8
+    if name == "transparent":
+        return c7kmap.TRANSPARENT
+    if name == "none":
+        return c7kmap.ACT_NONE
+    raise ValueError("unknown action %s" % name)
+
+def compile_keymap(lines):
+    # Layer names are needed before the entries that refer to them
+    layers = []
+    for line in lines:
+        words = line.split("#")[0].split()
+        if words and words[0] == "layer":
+            layers.append(words[1])
+    if not layers:
+        layers.append("base")
+    tables = [[c7kmap.ACT_NONE] * 128 for _ in layers]
+    settings = {}
+    texts = []
+    layer = 0
+    seen_layers = 0
+    for number, line in enumerate(lines, 1):
+        # A text runs to the end of the line and may contain "#" and runs of
+        # spaces, so it is taken from the line as written
+        match = TEXT_ENTRY.match(line)
+        if match:
+            words = match.group(1).split() + ["text", match.group(2)]
+        else:
+            words = line.split("#")[0].split()
+        if not words:
+            continue
+        try:
+            if words[0] == "layer":
+                layer = seen_layers
+                seen_layers += 1
+            elif words[0] == "set":
+                if words[1] not in c7kmap.SETTINGS_NAMES:
+                    raise ValueError("unknown setting %s" % words[1])
+                settings[words[1]] = int(words[2])
+            else:
+                mask = 0
+                while words[0].isdigit():
+                    key = int(words.pop(0))
+                    if key > 6:
+                        raise ValueError("key %d is not 0-6" % key)
+                    mask |= 1 << key
+                if not mask:
+                    raise ValueError("entry has no keys")
+                tables[layer][mask] = parse_action(words, layers, texts)
+        except (IndexError, ValueError, SyntaxError) as error:
+            sys.exit("line %d: %s: %s" % (number, error, line.strip()))
+    return layers, tables, settings, texts
+
+def decompile_keymap(data):
+    keymap = c7kmap.unpack(data)
+    if keymap is None:
+        sys.exit("not a valid keymap")
+    tables, settings, texts = keymap
+    lines = ["set %s %d" % (name, settings[name])
+             for name in c7kmap.SETTINGS_NAMES if name in settings]
+    for layer, table in enumerate(tables):
+        lines.append("")
+        lines.append("layer %d" % layer)
+        for mask in range(1, 128):
+            action = table[mask]
+            if action == c7kmap.ACT_NONE:
+                continue
+            keys = " ".join(str(i) for i in range(7) if mask & (1 << i))
+            kind = action >> 8
+            arg = action & 0xFF
+            if action == c7kmap.TRANSPARENT:
+                text = "transparent"
+            elif kind == c7kmap.ACT_KEY:
+                text = "key " + keycode_name(arg)
+            elif kind == c7kmap.ACT_ONESHOT:
+                text = "oneshot " + " ".join(keycode_name(LEFT_CONTROL + bit)
+                                             for bit in range(8) if arg & (1 << bit))
+            elif kind == c7kmap.ACT_TEXT and arg < len(texts):
+                text = "text " + repr(c7kmap.decode_text(texts[arg]))
+            elif kind == c7kmap.ACT_CALIBRATE:
+                text = "calibrate"
+            elif kind == c7kmap.ACT_UNDO:
+                text = "undo"
+            elif kind in ACTION_NAMES:
+                text = "%s %d" % (ACTION_NAMES[kind], arg)
+            else:
+                text = "# unknown action 0x%04x" % action
+            lines.append("%s %s" % (keys, text))
+    return lines
+
+parser = argparse.ArgumentParser(description="Compile a text keymap for ble-both.py")
+parser.add_argument("keymap", help="text keymap, or binary keymap with --decompile")
+parser.add_argument("-o", "--output", default="keymap.bin", help="binary keymap to write")
+parser.add_argument("--decompile", action="store_true", help="print a binary keymap as text")
+args = parser.parse_args()
+
+if args.decompile:
+    with open(args.keymap, "rb") as keymap_file:
+        print("\n".join(decompile_keymap(keymap_file.read())))
+else:
+    with open(args.keymap) as keymap_file:
+        layers, tables, settings, texts = compile_keymap(keymap_file.read().splitlines())
+    data = c7kmap.pack(tables, settings, texts)
+    with open(args.output, "wb") as keymap_file:
+        keymap_file.write(data)
+    print("%s: %d layers (%s), %d texts, %d settings, %d bytes"
+          % (args.output, len(tables), ", ".join(layers), len(texts), len(settings), len(data)))
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# Host side of the keyboard's binary control channel (c7klink.py). Talks to
+# the second USB serial port that boot.py enables (the data port, not the
+# console). Needs pyserial.
+#
+#   python3 host-link.py /dev/ttyACM1 ping
+#   python3 host-link.py /dev/ttyACM1 metrics
+#   python3 host-link.py /dev/ttyACM1 get-keymap keymap.bin
+#   python3 host-link.py /dev/ttyACM1 put-keymap keymap.bin
+#   python3 host-link.py /dev/ttyACM1 clear-keymap
+#   python3 host-link.py /dev/ttyACM1 tail
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import c7klink
+
+try:
+    import serial
+except ImportError:
+    sys.exit("host-link.py needs pyserial: pip install pyserial")
+
+ERROR_NAMES = {c7klink.ERR_BAD_FRAME: "bad frame", c7klink.ERR_UNKNOWN: "unknown request",
+               c7klink.ERR_BAD_KEYMAP: "keymap rejected", c7klink.ERR_BUSY: "busy, retry",
+               c7klink.ERR_TOO_LARGE: "larger than %d bytes" % c7klink.MAX_PAYLOAD}
+
+def read_exact(port, count):
+    data = port.read(count)
+    if len(data) < count:
+        raise TimeoutError("no reply from the keyboard")
+    return data
+
+def read_frame(port):
+    # (type, payload) of the next valid frame
+    while True:
+        if read_exact(port, 1)[0] != c7klink.SYNC:
+            continue
+        header = read_exact(port, 3)
+        length = header[1] | (header[2] << 8)
+        if length > c7klink.MAX_PAYLOAD:
+            continue
+        rest = read_exact(port, length + 1)
+        frame = bytes((c7klink.SYNC,)) + header + rest
+        if c7klink.checksum(frame, 1, len(frame) - 1) == frame[-1]:
+            return header[0], rest[:-1]
+
+def request(port, kind, payload=b""):
+    port.write(c7klink.frame(kind, payload))
+    while True:
+        reply, data = read_frame(port)
+        if reply == kind | c7klink.REPLY:
+            return data
+        if reply == c7klink.ERROR and data[0] == kind:
+            sys.exit("keyboard: " + ERROR_NAMES.get(data[1], "error %d" % data[1]))
+        # Anything else is a leftover tail record
+
+def keys_text(mask):
+    return "".join(str(i) if mask & (1 << i) else "." for i in range(7))
+
+def report_text(device, report):
+    if device == 0:
+        mods = report[0]
+        keys = " ".join("%02x" % k for k in report[2:] if k)
+        return "keyboard mods %02x keys %s" % (mods, keys or "-")
+    x = report[1] - 256 if report[1] > 127 else report[1]
+    y = report[2] - 256 if report[2] > 127 else report[2]
+    return "mouse buttons %02x x %d y %d" % (report[0], x, y)
+
+def tail(port):
+    request(port, c7klink.TAIL, b"\x01")
+    print("Tailing, Ctrl-C to stop. Times are the keyboard's ms clock, mod 65536.")
+    try:
+        while True:
+            try:
+                kind, data = read_frame(port)
+            except TimeoutError:
+                continue
+            ms = data[0] | (data[1] << 8) if len(data) >= 2 else 0
+            if kind == c7klink.REC_KEYS:
+                print("%5d keys   %s %s" % (ms, keys_text(data[2]), keys_text(data[3])))
+            elif kind == c7klink.REC_REPORT:
+                print("%5d report %s" % (ms, report_text(data[2], data[3:])))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        port.write(c7klink.frame(c7klink.TAIL, b"\x00"))
+
+parser = argparse.ArgumentParser(description="Talk to the keyboard's control channel")
+parser.add_argument("port", help="data serial port, e.g. /dev/ttyACM1 or COM5")
+parser.add_argument("command", choices=("ping", "metrics", "get-keymap", "put-keymap",
+                                        "clear-keymap", "tail"))
+parser.add_argument("file", nargs="?", help="keymap file for get-keymap / put-keymap")
+parser.add_argument("--timeout", type=float, default=2.0, help="reply timeout in seconds")
+args = parser.parse_args()
+if args.command in ("get-keymap", "put-keymap") and not args.file:
+    parser.error(args.command + " needs a keymap file")
+
+port = serial.Serial(args.port, timeout=args.timeout)
+if args.command == "ping":
+    start = time.monotonic()
+    version = request(port, c7klink.PING)[0]
+    print("protocol %d, round trip %.1f ms" % (version, (time.monotonic() - start) * 1000))
+elif args.command == "metrics":
+    values = c7klink.unpack_u32(request(port, c7klink.GET_METRICS))
+    for name, value in zip(c7klink.METRICS_NAMES, values):
+        print("%s %d" % (name, value))
+elif args.command == "get-keymap":
+    data = request(port, c7klink.GET_KEYMAP)
+    with open(args.file, "wb") as keymap_file:
+        keymap_file.write(data)
+    print("%s: %d bytes" % (args.file, len(data)))
+elif args.command == "put-keymap":
+    with open(args.file, "rb") as keymap_file:
+        data = keymap_file.read()
+    if len(data) > c7klink.MAX_PAYLOAD:
+        sys.exit("%s: %d bytes, the control channel takes at most %d; use fewer layers or texts,"
+                 " or copy it to CIRCUITPY as keymap.bin" % (args.file, len(data), c7klink.MAX_PAYLOAD))
+    start = time.monotonic()
+    request(port, c7klink.PUT_KEYMAP, data)
+    print("uploaded %d bytes in %.0f ms" % (len(data), (time.monotonic() - start) * 1000))
+elif args.command == "clear-keymap":
+    request(port, c7klink.PUT_KEYMAP)
+    print("stored keymap cleared; the keymap file or built-in layers apply from the next boot")
+else:
+    tail(port)